@@ -11,17 +11,58 @@ from .utils.payment_api import CurrencyType
 
 log = get_logger()
 
+# how many addresses a moderator can check in one command
+MAX_LOOKUP_ADDRESSES = 100
+# addresses per reply, addresses can be up to 256 characters and a message only 2000
+ADDRESSES_PER_MESSAGE = 5
+
 # TODO:
 
 # add/remove/edit/view linked addresses
 # view own/others public addresses
-# look user up by public address
+# look user up by public address [x]
 
 
 class Accounts(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+    @staticmethod
+    def format_owners(owners):
+        lines = []
+        for (address, linked) in owners.items():
+            if linked:
+                users = ", ".join(f"<@{owner.user_id}> ({owner.address.currency.value})" for owner in linked)
+
+            else:
+                users = "nobody"
+
+            lines.append(f"`{address}`: {users}")
+
+        return "\n".join(lines)
+
+    @commands.group(name="whois", brief="look a user up by their public address", invoke_without_command=True)
+    async def whois_group(self, ctx, address: str):
+        owners = await self.bot.db.get_address_owners((address,), user_id=ctx.author.id)
+
+        await ctx.send(self.format_owners(owners), allowed_mentions=discord.AllowedMentions.none())
+
+    @whois_group.command(name="bulk", brief="look up a list of addresses, private ones included")
+    @commands.is_owner()
+    async def whois_bulk(self, ctx, *addresses: str):
+        if not addresses:
+            await self.bot.post_reaction(ctx.message, emoji="\N{SHRUG}")
+
+        elif len(addresses) > MAX_LOOKUP_ADDRESSES:
+            await ctx.send(f"\N{WARNING SIGN} At most {MAX_LOOKUP_ADDRESSES} addresses at once")
+
+        else:
+            owners = await self.bot.db.get_address_owners(addresses, include_private=True, user_id=ctx.author.id)
+
+            for start in range(0, len(addresses), ADDRESSES_PER_MESSAGE):
+                chunk = {address: owners[address] for address in addresses[start : start + ADDRESSES_PER_MESSAGE]}
+                await ctx.send(self.format_owners(chunk), allowed_mentions=discord.AllowedMentions.none())
+
 
 def setup(bot):
     bot.add_cog(Accounts(bot))
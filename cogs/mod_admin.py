@@ -31,13 +31,36 @@ MaybeRemoteMember = Union[discord.Member, discord.User]
 # [moderator] transaction control [x]
 # [moderator] lock/unlock user accounts
 # [moderator] transaction view (all recent, recent by criteria, all by criteria)
-# [moderator] action view (same as above)
+# [moderator] action view (same as above) [by payment id]
 
 
 class Admin(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+    @commands.command(name="history", brief="show every action taken on payments")
+    @commands.is_owner()
+    async def payment_history(self, ctx, *payment_ids: int):
+        if not payment_ids:
+            await self.bot.post_reaction(ctx.message, emoji="\N{SHRUG}")
+            return
+
+        histories = await self.bot.db.get_histories(payment_ids, user_id=ctx.author.id)
+
+        for (payment_id, events) in histories.items():
+            lines = [f"**Payment {payment_id}**"]
+
+            for event in events:
+                note = f": {event.action_message}" if event.action_message else ""
+                lines.append(
+                    f"`{event.action_at:%Y-%m-%d %H:%M:%S}` {event.action.name} by {event.actioner.name.lower()} <@{event.actioner_id}>{note}"
+                )
+
+            if not events:
+                lines.append("*no actions yet*")
+
+            await ctx.send("\n".join(lines), allowed_mentions=discord.AllowedMentions.none())
+
 
 def setup(bot):
     bot.add_cog(Admin(bot))
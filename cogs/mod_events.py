@@ -42,10 +42,10 @@ class Events(commands.Cog):
             await ctx.send("\N{WARNING SIGN} You cannot use that command in a direct message channel")
 
         elif isinstance(error, commands.CommandNotFound):
-            log.debug(f"Could not find command '{ctx.invoked_with}' for '{ctx.author.name}'")
+            log.debug("Could not find command '%s' for '%s'", ctx.invoked_with, ctx.author.name)
 
         elif isinstance(error, commands.CheckFailure):
-            log.debug(f"Check failed for '{ctx.author.name}' on '{ctx.invoked_with}'")
+            log.debug("Check failed for '%s' on '%s'", ctx.author.name, ctx.invoked_with)
 
         elif isinstance(error, commands.DisabledCommand):
             await self.bot.post_reaction(ctx.message)
@@ -36,7 +36,7 @@ class Pay(commands.Cog):
     @commands.command(name="addrs_for")
     @commands.is_owner()
     async def check_addr(self, ctx, coin: CurrencyType):
-        currency_data = await self.bot.db.get_addresses_for(ctx.author.id, coin)
+        currency_data = await self.bot.db.get_address_for(ctx.author.id, coin)
 
         await ctx.send(f"```\n{currency_data!r}\n```")
 
@@ -58,7 +58,7 @@ class Pay(commands.Cog):
     @commands.is_owner()
     async def get_amount(self, ctx, amount: Decimal, coin: CurrencyType):
         try:
-            verified_amount = await self.bot.db.ensure_precise_amount(coin, amount)
+            verified_amount = self.bot.db.ensure_precise_amount(coin, amount)
 
         except DecimalInvalidAmountError as e:
             await ctx.send(
@@ -46,58 +46,52 @@ class Admin(commands.Cog):
     @admin_group.command(name="release", brief="release money to the recipient")
     @commands.is_owner()
     async def admin_release(self, ctx, sender: MaybeRemoteMember, recipient: MaybeRemoteMember):
-        maybe_transaction = await self.bot.db.get_active_payment_by_participants(sender.id, recipient.id)
-
-        if maybe_transaction is None:
+        transition = await self.bot.db.transition_active_payment(
+            sender.id,
+            recipient.id,
+            EscrowStatus.Completed,
+            EscrowAction.Released,
+            EscrowActioner.Moderator,
+            ctx.author.id,
+            expected=(EscrowStatus.Received,),
+        )
+
+        if transition.payment is None:
             await ctx.send(
                 f"\N{WARNING SIGN} Looks like {sender.name} doesn't have a transaction going to {recipient.name}.",
                 reference=ctx.message,
             )
 
+        elif not transition.applied:
+            await ctx.send(
+                f"\N{NO ENTRY} {sender.name} has not paid this transaction yet, it cannot be released.",
+                reference=ctx.message,
+            )
+
         else:
-            if maybe_transaction.status == EscrowStatus.Pending:
-                await ctx.send(
-                    f"\N{NO ENTRY} {sender.name} has not paid this transaction yet, it cannot be released.",
-                    reference=ctx.message,
-                )
-
-            else:
-                did_report = await self.bot.db.create_payment_event(
-                    maybe_transaction.id, EscrowAction.Released, EscrowActioner.Moderator, ctx.author.id
-                )
-                did_update = await self.bot.db.update_payment_status(maybe_transaction.id, EscrowStatus.Completed)
-
-                if not (did_report and did_update):
-                    log.critical(
-                        f"Could not write payment event for ({maybe_transaction.id}, s={maybe_transaction.sender}, r={maybe_transaction.receiver}"
-                    )
-                    raise RuntimeError("database write failed")
-
-                await ctx.send(f"Released {sender.name}'s transaction (ID: {maybe_transaction.id}) to {recipient.name}")
+            await ctx.send(f"Released {sender.name}'s transaction (ID: {transition.payment.id}) to {recipient.name}")
 
     @admin_group.command(name="cancel", brief="cancel a transaction and refund")
     @commands.is_owner()
     async def admin_cancel(self, ctx, sender: MaybeRemoteMember, recipient: MaybeRemoteMember, *, reason: str = None):
-        maybe_transaction = await self.bot.db.get_active_payment_by_participants(sender.id, recipient.id)
-
-        if maybe_transaction is None:
+        transition = await self.bot.db.transition_active_payment(
+            sender.id,
+            recipient.id,
+            EscrowStatus.Failed,
+            EscrowAction.Cancelled,
+            EscrowActioner.Moderator,
+            ctx.author.id,
+            message=reason,
+        )
+
+        # a moderator may cancel anything still active, so a miss means there was nothing to cancel
+        if not transition.applied:
             await ctx.send(
                 f"\N{WARNING SIGN} Looks like {sender.name} doesn't have a transaction going to {recipient.name}.",
                 reference=ctx.message,
             )
 
         else:
-            did_report = await self.bot.db.create_payment_event(
-                maybe_transaction.id, EscrowAction.Cancelled, EscrowActioner.Moderator, ctx.author.id, message=reason
-            )
-            did_update = await self.bot.db.update_payment_status(maybe_transaction.id, EscrowStatus.Failed)
-
-            if not (did_report and did_update):
-                log.critical(
-                    f"Could not write payment event for ({maybe_transaction.id}, s={maybe_transaction.sender}, r={maybe_transaction.receiver}"
-                )
-                raise RuntimeError("database write failed")
-
             await ctx.send(
                 f"Cancelling {sender.name}'s transaction to {recipient.name}. They will be refunded shortly.\n{f'> {reason}' if reason else ''}"
             )
@@ -10,6 +10,7 @@ import discord
 from discord.ext import commands
 
 from .utils.db import (
+    ActivePaymentExistsError,
     DecimalInvalidAmountError,
     DecimalPrecisionError,
     EscrowAction,
@@ -77,8 +78,8 @@ class Escrow(commands.Cog):
 
     # make sure we have addresses, one way or another
     async def do_address_flow(self, msg, sender, receiver, currency, *, amount=None):
-        sender_address = await self.bot.db.get_address_for(sender.id, currency)
-        receiver_address = await self.bot.db.get_address_for(receiver.id, currency)
+        addresses = await self.bot.db.get_addresses_for_users((sender.id, receiver.id), currency)
+        (sender_address, receiver_address) = (addresses[sender.id], addresses[receiver.id])
 
         def is_sender_dm_response(message):
             return (
@@ -183,11 +184,10 @@ class Escrow(commands.Cog):
             )
 
         else:
-            await self.bot.db.ensure_user(sender.id)
-            await self.bot.db.ensure_user(recipient.id)
+            await self.bot.db.ensure_users((sender.id, recipient.id))
 
             try:
-                verified_amount = await self.bot.db.ensure_precise_amount(currency, amount)
+                verified_amount = self.bot.db.ensure_precise_amount(currency, amount)
 
             except DecimalInvalidAmountError as e:
                 await ctx.send(f"\N{WARNING SIGN} The amount ({e.args[0]}) is not valid")
@@ -213,10 +213,19 @@ class Escrow(commands.Cog):
                         )
 
                 else:
+                    # another send may have won the race while we were waiting on the address flow
+                    try:
+                        payment_id = await self.bot.db.create_payment(
+                            currency, sender.id, recipient.id, sender_addr, receiver_addr, verified_amount, reason=note
+                        )
+
+                    except ActivePaymentExistsError:
+                        await ctx.send(
+                            f"\N{NO ENTRY} Sorry, you already have an active transaction with {recipient.name}.\nFinish or close that one before opening a new one.",
+                            reference=ctx.message,
+                        )
+                        return
 
-                    payment_id = await self.bot.db.create_payment(
-                        currency, sender.id, recipient.id, sender_addr, receiver_addr, verified_amount, reason=note
-                    )
                     if payment_id is None:
                         log.critical(f"Could not write payment event for (UNSET, s={sender.id}, r={recipient.id}")
                         raise RuntimeError("database write failed")
@@ -230,106 +239,96 @@ class Escrow(commands.Cog):
     async def escrow_abort(self, ctx, recipient: MaybeRemoteMember, *, reason: str = None):
         sender = ctx.author
 
-        maybe_transaction = await self.bot.db.get_active_payment_by_participants(sender.id, recipient.id)
-
-        if maybe_transaction is None:
+        transition = await self.bot.db.transition_active_payment(
+            sender.id,
+            recipient.id,
+            EscrowStatus.Failed,
+            EscrowAction.Aborted,
+            EscrowActioner.Sender,
+            sender.id,
+            expected=(EscrowStatus.Pending,),
+            message=reason,
+        )
+
+        if transition.payment is None:
             await ctx.send(
                 f"\N{WARNING SIGN} Looks like you don't have an active transaction going to {recipient.name}.",
                 reference=ctx.message,
             )
 
-        else:
-            if maybe_transaction.status == EscrowStatus.Received:
-                await ctx.send(
-                    f"\N{NO ENTRY} You cannot abort a paid transaction. Ask the recipient or an escrow manager to cancel it for you.",
-                    reference=ctx.message,
-                )
-
-            else:
-                did_report = await self.bot.db.create_payment_event(
-                    maybe_transaction.id, EscrowAction.Aborted, EscrowActioner.Sender, sender.id, message=reason
-                )
-                did_update = await self.bot.db.update_payment_status(maybe_transaction.id, EscrowStatus.Failed)
-
-                if not (did_report and did_update):
-                    log.critical(
-                        f"Could not write payment event for ({maybe_transaction.id}, s={maybe_transaction.sender}, r={maybe_transaction.receiver}"
-                    )
-                    raise RuntimeError("database write failed")
+        elif not transition.applied:
+            await ctx.send(
+                f"\N{NO ENTRY} You cannot abort a paid transaction. Ask the recipient or an escrow manager to cancel it for you.",
+                reference=ctx.message,
+            )
 
-                await ctx.send(
-                    f"Aborted your pending transaction (ID: {maybe_transaction.id}) with {recipient.name}\n{f'> {reason}' if reason else ''}"
-                )
+        else:
+            await ctx.send(
+                f"Aborted your pending transaction (ID: {transition.payment.id}) with {recipient.name}\n{f'> {reason}' if reason else ''}"
+            )
 
     @escrow_group.command(name="release", brief="release escrow money to the recipient")
     @commands.is_owner()
     async def escrow_release(self, ctx, recipient: MaybeRemoteMember):
         sender = ctx.author
 
-        maybe_transaction = await self.bot.db.get_active_payment_by_participants(sender.id, recipient.id)
-
-        if maybe_transaction is None:
+        transition = await self.bot.db.transition_active_payment(
+            sender.id,
+            recipient.id,
+            EscrowStatus.Completed,
+            EscrowAction.Released,
+            EscrowActioner.Sender,
+            sender.id,
+            expected=(EscrowStatus.Received,),
+        )
+
+        if transition.payment is None:
             await ctx.send(
                 f"\N{WARNING SIGN} Looks like you don't have an active transaction going to {recipient.name}.",
                 reference=ctx.message,
             )
 
-        else:
-            if maybe_transaction.status == EscrowStatus.Pending:
-                await ctx.send(
-                    f"\N{NO ENTRY} You cannot release an unpaid transaction.\n(If you wish to cancel this transaction, you may do `{ctx.prefix}{self.bot.get_command('escrow abort').qualified_name}`)",
-                    reference=ctx.message,
-                )
-
-            else:
-                did_report = await self.bot.db.create_payment_event(
-                    maybe_transaction.id, EscrowAction.Released, EscrowActioner.Sender, sender.id
-                )
-                did_update = await self.bot.db.update_payment_status(maybe_transaction.id, EscrowStatus.Completed)
-
-                if not (did_report and did_update):
-                    log.critical(
-                        f"Could not write payment event for ({maybe_transaction.id}, s={maybe_transaction.sender}, r={maybe_transaction.receiver}"
-                    )
-                    raise RuntimeError("database write failed")
+        elif not transition.applied:
+            await ctx.send(
+                f"\N{NO ENTRY} You cannot release an unpaid transaction.\n(If you wish to cancel this transaction, you may do `{ctx.prefix}{self.bot.get_command('escrow abort').qualified_name}`)",
+                reference=ctx.message,
+            )
 
-                await ctx.send(f"Released your transaction (ID: {maybe_transaction.id}) to {recipient.name}")
+        else:
+            await ctx.send(f"Released your transaction (ID: {transition.payment.id}) to {recipient.name}")
 
     @escrow_group.command(name="cancel", brief="cancel a transaction and refund money")
     @commands.is_owner()
     async def escrow_cancel(self, ctx, sender: MaybeRemoteMember, *, reason: str = None):
         recipient = ctx.author
 
-        maybe_transaction = await self.bot.db.get_active_payment_by_participants(sender.id, recipient.id)
-
-        if maybe_transaction is None:
+        transition = await self.bot.db.transition_active_payment(
+            sender.id,
+            recipient.id,
+            EscrowStatus.Failed,
+            EscrowAction.Cancelled,
+            EscrowActioner.Recipient,
+            recipient.id,
+            expected=(EscrowStatus.Received,),
+            message=reason,
+        )
+
+        if transition.payment is None:
             await ctx.send(
                 f"\N{WARNING SIGN} Looks like you don't have an active transaction coming from {sender.name}.",
                 reference=ctx.message,
             )
 
-        else:
-            if maybe_transaction.status == EscrowStatus.Pending:
-                await ctx.send(
-                    f"\N{NO ENTRY} You cannot cancel a pending transaction.\nHave the sender abort or have an escrow manager cancel for you.",
-                    reference=ctx.message,
-                )
-
-            else:
-                did_report = await self.bot.db.create_payment_event(
-                    maybe_transaction.id, EscrowAction.Cancelled, EscrowActioner.Recipient, recipient.id, message=reason
-                )
-                did_update = await self.bot.db.update_payment_status(maybe_transaction.id, EscrowStatus.Failed)
-
-                if not (did_report and did_update):
-                    log.critical(
-                        f"Could not write payment event for ({maybe_transaction.id}, s={maybe_transaction.sender}, r={maybe_transaction.receiver}"
-                    )
-                    raise RuntimeError("database write failed")
+        elif not transition.applied:
+            await ctx.send(
+                f"\N{NO ENTRY} You cannot cancel a pending transaction.\nHave the sender abort or have an escrow manager cancel for you.",
+                reference=ctx.message,
+            )
 
-                await ctx.send(
-                    f"Cancelling your escrow transaction with {sender.name}. They will be refunded shortly.\n{f'> {reason}' if reason else ''}"
-                )
+        else:
+            await ctx.send(
+                f"Cancelling your escrow transaction with {sender.name}. They will be refunded shortly.\n{f'> {reason}' if reason else ''}"
+            )
 
 
 def setup(bot):
@@ -0,0 +1,116 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2021 Mieszko Exchange
+
+# Small in-process caches for hot lookups
+
+__all__ = ("LRUCache", "TTLCache")
+
+import asyncio
+import time
+from collections import Counter, OrderedDict
+
+
+class LRUCache:
+    """A bounded mapping that evicts the least recently used key once full."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    # a hit counts as a use, so keys that are only ever probed with `in` still stay while they're hot
+    def __contains__(self, key):
+        try:
+            self._data.move_to_end(key)
+
+        except KeyError:
+            return False
+
+        return True
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+
+        except KeyError:
+            return default
+
+        return self._data[key]
+
+    def set(self, key, value=None):
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+
+class TTLCache:
+    """Remembers loaded values for `ttl` seconds, concurrent misses on a key share a single load ("single-flight").
+
+    Failed loads aren't cached, every caller waiting on one gets its exception.
+    """
+
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+
+        # key -> (monotonic expiry, value)
+        self._data = LRUCache(maxsize)
+        # key -> the task loading it
+        self._inflight = {}
+        # key -> bumped by `invalidate`, so a load that started before it doesn't store a stale value
+        self._generations = Counter()
+
+        self.counts = Counter()
+
+    async def _fill(self, key, load):
+        generation = self._generations[key]
+
+        try:
+            value = await load()
+
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+
+        if self._generations[key] == generation:
+            self._data.set(key, (time.monotonic() + self.ttl, value))
+
+        return value
+
+    async def get_or_load(self, key, load):
+        entry = self._data.get(key)
+
+        if entry is not None and entry[0] > time.monotonic():
+            self.counts["hits"] += 1
+            return entry[1]
+
+        task = self._inflight.get(key)
+
+        if task is None:
+            self.counts["loads"] += 1
+            task = self._inflight[key] = asyncio.get_event_loop().create_task(self._fill(key, load))
+
+        else:
+            self.counts["coalesced"] += 1
+
+        # one impatient caller being cancelled mustn't cancel the load everyone else is waiting on
+        return await asyncio.shield(task)
+
+    # drops the value and detaches any load in flight, the next caller loads afresh
+    def invalidate(self, key):
+        self._generations[key] += 1
+        self._data.pop(key)
+        self._inflight.pop(key, None)
+
+    def stats(self):
+        return dict(self.counts, cached=len(self._data), in_flight=len(self._inflight))
@@ -5,29 +5,40 @@
 __all__ = (
     "DecimalPrecisionError",
     "DecimalInvalidAmountError",
+    "ActivePaymentExistsError",
     "EscrowStatus",
     "EscrowAction",
     "EscrowActioner",
     "User",
     "EscrowPayment",
     "EscrowEvent",
+    "PaymentTransition",
     "SavedAddress",
+    "AddressOwner",
+    "CurrencyDetails",
     "SQL",
 )
 
 import asyncio
 import decimal
-from collections import namedtuple
+import hashlib
+import time
+from collections import Counter, namedtuple
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 from enum import Enum
-from textwrap import dedent
+from operator import attrgetter
 
 import aiomysql
 
-from .logger import get_logger, prepare_logger
+from . import queries as Q
+from .cache import LRUCache
+from .logger import StructuredMessage, get_logger, prepare_logger
+from .metrics import Histogram
 from .payment_api import CurrencyType
+from .pool import MeasuredPool
+from .records import Record, RowDecoder, lookup_table
 
 log = get_logger()
 prepare_logger("aiomysql")
@@ -37,6 +48,40 @@ d_context = decimal.Context(prec=18, rounding=decimal.ROUND_HALF_UP, Emin=decima
 
 decimal.setcontext(d_context)
 
+# how many user ids to remember as already existing, so repeat users skip the database
+KNOWN_USER_CACHE_SIZE = 10_000
+
+# payments per batched event history statement
+HISTORY_BATCH_SIZE = 500
+
+# addresses per reverse lookup statement
+ADDRESS_LOOKUP_BATCH_SIZE = 500
+
+# (user id, currency) pairs whose saved address (or lack of one) is kept in memory
+ADDRESS_CACHE_SIZE = 10_000
+ADDRESS_CACHE_TTL = 300.0  # seconds, a backstop for changes made outside the bot
+
+# rows per multi-row INSERT when creating users in bulk
+USER_BATCH_SIZE = 1000
+
+# read replica defaults, overridable in the [Database.Replica] config
+REPLICA_READ_YOUR_WRITES = 10.0  # seconds a user's reads stay on the primary after they write, at least max lag
+REPLICA_MAX_LAG = 10  # seconds behind the primary before reads stop going to the replica
+REPLICA_LAG_INTERVAL = 5.0  # seconds between replica lag checks
+REPLICA_LAG_WARN_INTERVAL = 300.0  # seconds between repeated "can't measure replica lag" warnings
+
+# statements slower than this (seconds) are logged, overridable as `slow_query_threshold` in [Database]
+SLOW_QUERY_THRESHOLD = 0.5
+
+# archival defaults, overridable in the [Archive] config
+ARCHIVE_AFTER_DAYS = 30  # finished payments untouched for this long move to EscrowPaymentArchive
+ARCHIVE_BATCH_SIZE = 500  # payments moved per transaction, keeps row locks on the hot table short
+ARCHIVE_PAUSE = 0.5  # seconds between batches, so archival never hogs the primary
+ARCHIVE_INTERVAL = 3600.0  # seconds between archival runs
+
+# MySQL error code for a UNIQUE/PRIMARY key collision
+ER_DUP_ENTRY = 1062
+
 DATETIME_STR = "%Y-%m-%d %H:%M:%S"
 TIMESTAMP_STR = f"{DATETIME_STR}.%f"
 
@@ -49,6 +94,10 @@ class DecimalInvalidAmountError(Exception):
     pass
 
 
+class ActivePaymentExistsError(Exception):
+    pass
+
+
 class EscrowStatus(Enum):
     Pending = "pending"
     Received = "paid"
@@ -56,6 +105,10 @@ class EscrowStatus(Enum):
     Failed = "failed"
 
 
+# statuses a payment can still move out of
+ACTIVE_STATUSES = (EscrowStatus.Pending, EscrowStatus.Received)
+
+
 class EscrowAction(Enum):
     Cancelled = "cancel"
     Released = "release"
@@ -68,36 +121,340 @@ class EscrowActioner(Enum):
     Moderator = "moderator"
 
 
-User = namedtuple("User", "id created_at locked")
+class User(Record):
+    __slots__ = ("id", "created_at", "locked")
 
-EscrowPayment = namedtuple(
-    "EscrowPayment",
-    "id currency sender receiver source_addr dest_addr status amount started_at for_message last_action_at",
+
+class EscrowPayment(Record):
+    __slots__ = (
+        "id",
+        "currency",
+        "sender",
+        "receiver",
+        "source_addr",
+        "dest_addr",
+        "status",
+        "amount",
+        "started_at",
+        "for_message",
+        "last_action_at",
+    )
+
+
+class EscrowEvent(Record):
+    __slots__ = ("id", "payment_id", "action", "actioner", "actioner_id", "action_at", "action_message")
+
+
+class SavedAddress(Record):
+    __slots__ = ("address", "is_public", "currency")
+
+
+# `payment` is None if there was nothing to act on, `applied` is False if its status didn't match what was expected
+PaymentTransition = namedtuple("PaymentTransition", "payment applied")
+
+# a user an address is linked to, `address` is their SavedAddress for it
+AddressOwner = namedtuple("AddressOwner", "user_id address")
+
+CurrencyDetails = namedtuple("CurrencyDetails", "id currency precision quantizer")
+
+
+class StatementStats:
+    """Timings for one registered statement, across every call."""
+
+    __slots__ = ("latency", "pool_wait", "rows", "errors", "slow")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.pool_wait = Histogram()
+        self.rows = 0
+        self.errors = 0
+        self.slow = 0
+
+    def summary(self):
+        return dict(
+            self.latency.summary(),
+            total=self.latency.total,
+            rows=self.rows,
+            errors=self.errors,
+            slow=self.slow,
+            pool_wait=self.pool_wait.mean,
+        )
+
+
+# parameters shown in the slow query log: types and sizes only, never the values themselves
+def _redact(values):
+    if isinstance(values, dict):
+        return {key: _redact(value) for (key, value) in values.items()}
+
+    if isinstance(values, (list, tuple)):
+        return f"{type(values).__name__}[{len(values)}]"
+
+    return type(values).__name__
+
+
+# Row decoders, by column position in the matching `queries` statement
+
+_currency_type = lookup_table(CurrencyType)
+
+# SELECT * FROM User
+USER_DECODER = RowDecoder(User, id=0, created_at=1, locked=(2, bool))
+
+# SELECT E.*, C.code FROM EscrowPayment E, Currency C (column 11 is the generated `active` flag)
+PAYMENT_DECODER = RowDecoder(
+    EscrowPayment,
+    id=0,
+    currency=(12, _currency_type),
+    sender=2,
+    receiver=3,
+    source_addr=4,
+    dest_addr=5,
+    status=(6, lookup_table(EscrowStatus)),
+    amount=7,
+    started_at=8,
+    for_message=9,
+    last_action_at=(10, RowDecoder.datetime_or_none),
+)
+
+# SELECT id, paymentID, action, actioner, actionerID, actionAt, actionMsg FROM EscrowEvent
+EVENT_DECODER = RowDecoder(
+    EscrowEvent,
+    id=0,
+    payment_id=1,
+    action=(2, lookup_table(EscrowAction)),
+    actioner=(3, lookup_table(EscrowActioner)),
+    actioner_id=4,
+    action_at=5,
+    action_message=6,
 )
-EscrowEvent = namedtuple("EscrowEvent", "payment_id action actioner actioner_id action_at action_message")
 
-SavedAddress = namedtuple("SavedAddress", "address is_public currency")
+# SELECT lA.address, lA.public, c.code FROM LinkedAddress lA, Currency c
+ADDRESS_DECODER = RowDecoder(SavedAddress, address=0, is_public=(1, bool), currency=(2, _currency_type))
+
+# SELECT lA.userID, lA.address, lA.public, c.code FROM LinkedAddress lA, Currency c (the user id is read separately)
+USER_ADDRESS_DECODER = RowDecoder(SavedAddress, address=1, is_public=(2, bool), currency=(3, _currency_type))
+
+# tells "not cached" apart from a cached "has no address"
+_MISSING = object()
+
+
+# the user ids to route a read by, for methods taking an optional `user_id` of whoever is reading
+def _given(user_id):
+    return () if user_id is None else (user_id,)
+
+
+# the statements behind one ordering of `get_payments` / `iter_payments`, and the sort key merging hot and archived
+PaymentListing = namedtuple("PaymentListing", "page archived_page scan archived_scan key")
+
+PAYMENTS_BY_ID = PaymentListing(
+    Q.PAYMENTS_PAGE, Q.ARCHIVED_PAYMENTS_PAGE, Q.PAYMENTS_SCAN, Q.ARCHIVED_PAYMENTS_SCAN, attrgetter("id")
+)
+PAYMENTS_BY_DATE = PaymentListing(
+    Q.PAYMENTS_PAGE_BY_DATE,
+    Q.ARCHIVED_PAYMENTS_PAGE_BY_DATE,
+    Q.PAYMENTS_SCAN_BY_DATE,
+    Q.ARCHIVED_PAYMENTS_SCAN_BY_DATE,
+    attrgetter("started_at", "id"),
+)
 
 
 class SQL:
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, replica=None, archive=None, **kwargs):
         self.loop = asyncio.get_event_loop()
 
         self.pool = None
+        self.replica_pool = None
+
+        # CurrencyType -> CurrencyDetails, filled from the Currency table by `refresh_currencies`
+        self.currencies = {}
+
+        # user ids known to have a User row (rows are never deleted, so this never goes stale) -> their `User`,
+        # or None if only the row's existence is known; lock changes drop back to None
+        self._known_users = LRUCache(KNOWN_USER_CACHE_SIZE)
+        # user id -> bumped by every User write, so a read that started before it doesn't cache a stale `User`
+        self._user_generations = Counter()
+
+        # (user id, CurrencyType) -> (monotonic expiry, SavedAddress or None), written through by `add_address_for`
+        # and dropped by every other LinkedAddress write
+        self._addresses = LRUCache(ADDRESS_CACHE_SIZE)
+        # user id -> bumped by every LinkedAddress write, so a read that started before it doesn't store a stale value
+        self._address_generations = Counter()
+
+        # Per-statement timings, see `query_stats`
+        self.slow_query_threshold = kwargs.pop("slow_query_threshold", SLOW_QUERY_THRESHOLD)
+        self.statements = {}
+
+        # Read replica routing
+        replica = dict(replica or {})
+        self.max_replica_lag = replica.pop("max_lag", REPLICA_MAX_LAG)
+        # a replica serving reads can be up to max_lag behind, so a shorter window would still show stale data
+        self.read_your_writes = max(replica.pop("read_your_writes", REPLICA_READ_YOUR_WRITES), self.max_replica_lag)
+        self.replica_lag_interval = replica.pop("lag_interval", REPLICA_LAG_INTERVAL)
+
+        # user id -> monotonic time of their last write, for read-your-writes
+        self._recent_writers = LRUCache(KNOWN_USER_CACHE_SIZE)
+        # monotonic time of the last write by anyone, for reads that can't say whose writes they depend on
+        self._last_write = 0.0
+
+        # seconds the replica is behind, None until measured (or if it can't be)
+        self.replica_lag = None
+        self.routing = Counter()
+
+        # pools are only created by `init`, set once they're warmed up and the currencies are loaded
+        self._ready = asyncio.Event()
+        self._pool_args = (replica or None, kwargs)
+
+        # Archival of finished payments, only scheduled if there's an [Archive] config
+        self.archive_config = archive
+        archive = dict(archive or {})
+        self.archive_after = timedelta(days=archive.get("after_days", ARCHIVE_AFTER_DAYS))
+        self.archive_batch_size = archive.get("batch_size", ARCHIVE_BATCH_SIZE)
+        self.archive_pause = archive.get("pause", ARCHIVE_PAUSE)
+        self.archive_interval = archive.get("interval", ARCHIVE_INTERVAL)
+
+        self.archived = 0
+
+        self.__lag_task = None
+        self.__archive_task = None
+        self.__init_task = None
+
+    async def _generate_pool(self, replica, *, host, user, password, db, port=3306, **kwargs):
+        self.pool = MeasuredPool(
+            await aiomysql.create_pool(
+                host=host, port=port, user=user, password=password, db=db, loop=self.loop, **kwargs
+            )
+        )
 
-        self.__pool_task = self.loop.create_task(self._generate_pool(**kwargs))
+        # same pool settings, replica connection details fall back to the primary's
+        if replica is not None:
+            credentials = dict(host=host, port=port, user=user, password=password, db=db)
+            credentials.update(replica)
 
-    async def _generate_pool(self, *, host, user, password, db, port=3306, **kwargs):
-        self.pool = await aiomysql.create_pool(
-            host=host, port=port, user=user, password=password, db=db, loop=self.loop, **kwargs
-        )
+            self.replica_pool = MeasuredPool(await aiomysql.create_pool(loop=self.loop, **credentials, **kwargs))
+
+        for pool in (self.pool, self.replica_pool):
+            if pool is not None:
+                await pool.warm_up()
+
+    async def _start(self):
+        (replica, kwargs) = self._pool_args
+        started = time.perf_counter()
+
+        await self._generate_pool(replica, **kwargs)
+
+        if self.replica_pool is not None:
+            self.__lag_task = self.loop.create_task(self._watch_replica_lag())
 
-        await asyncio.sleep(1)
+        if self.archive_config is not None:
+            self.__archive_task = self.loop.create_task(self._archive_loop())
 
-    # async-friendly init
+        await self.refresh_currencies()
+
+        self._ready.set()
+        log.info("Database ready, %d connection(s) warmed up in %.3fs", self.pool.size, time.perf_counter() - started)
+
+    # for anything that needs the pool but shouldn't be the one to initialize it
+    async def wait_until_ready(self):
+        await self._ready.wait()
+
+    @property
+    def is_ready(self):
+        return self._ready.is_set()
+
+    # creates and warms up the pools once, later (or concurrent) calls just wait for that to finish
     async def init(self):
-        if not self.__pool_task.done():
-            await self.__pool_task
+        if self.__init_task is None:
+            self.__init_task = self.loop.create_task(self._start())
+
+        await asyncio.shield(self.__init_task)
+
+    def pool_stats(self):
+        return {name: pool.stats() for (name, pool) in (("primary", self.pool), ("replica", self.replica_pool)) if pool}
+
+    # Read/write routing
+
+    # remember who just wrote, so their own reads don't hit a replica that hasn't caught up yet
+    def _note_write(self, *user_ids):
+        now = time.monotonic()
+        self._last_write = now
+
+        for user_id in user_ids:
+            self._recent_writers.set(user_id, now)
+
+    # the pool `query` should run on, given the users whose data it reads (or who is reading); writes (and locking
+    # reads) go to the primary, and so do reads naming nobody while anyone's write may not have replicated yet
+    def _pool_for(self, query, *user_ids):
+        if query.kind is Q.QueryKind.Write or self.replica_pool is None:
+            return self.pool
+
+        cutoff = time.monotonic() - self.read_your_writes
+        if user_ids:
+            recent = any(self._recent_writers.get(user_id, 0) > cutoff for user_id in user_ids)
+
+        else:
+            recent = self._last_write > cutoff
+
+        if recent:
+            self.routing["primary_read_your_writes"] += 1
+            return self.pool
+
+        # not measured yet, or can't be: assume the worst
+        if self.replica_lag is None:
+            self.routing["primary_replica_lag_unknown"] += 1
+            return self.pool
+
+        if self.replica_lag > self.max_replica_lag:
+            self.routing["primary_replica_lagging"] += 1
+            return self.pool
+
+        self.routing["replica"] += 1
+        return self.replica_pool
+
+    async def _measure_replica_lag(self):
+        async with self.replica_pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                # MySQL 8.0.22+ and MariaDB 10.5.1+ spell it REPLICA, older servers only know SLAVE
+                try:
+                    await cur.execute("SHOW REPLICA STATUS;")
+
+                except aiomysql.ProgrammingError:
+                    await cur.execute("SHOW SLAVE STATUS;")
+
+                status = await cur.fetchone()
+
+        if not status:
+            return None
+
+        lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+
+        # NULL while replication is stopped, which is as good as infinitely behind
+        return float("inf") if lag is None else lag
+
+    async def _watch_replica_lag(self):
+        # loop time of the last warning, None while measuring works
+        warned_at = None
+
+        while True:
+            try:
+                self.replica_lag = await self._measure_replica_lag()
+
+            except Exception as e:
+                self.replica_lag = None
+
+                # once when it starts failing, then every REPLICA_LAG_WARN_INTERVAL while it keeps failing
+                now = self.loop.time()
+                if warned_at is None or now - warned_at >= REPLICA_LAG_WARN_INTERVAL:
+                    warned_at = now
+                    log.warning("Could not measure replica lag: [%s]: %s", type(e).__name__, e)
+
+            else:
+                if warned_at is not None:
+                    warned_at = None
+                    log.info("Measuring replica lag again, %s seconds behind", self.replica_lag)
+
+            await asyncio.sleep(self.replica_lag_interval)
+
+    def routing_stats(self):
+        return dict(self.routing, replica_lag=self.replica_lag, has_replica=self.replica_pool is not None)
 
     @staticmethod
     def to_time_str(date_time):
@@ -116,33 +473,166 @@ class SQL:
         return datetime.strptime(stamp, TIMESTAMP_STR)
 
     async def close(self):
-        if self.pool:
-            self.pool.close()
-            await self.pool.wait_closed()
+        for task in (self.__lag_task, self.__archive_task):
+            if task is not None:
+                task.cancel()
+
+        for pool in (self.pool, self.replica_pool):
+            if pool:
+                pool.close()
+                await pool.wait_closed()
 
     # Query methods
 
+    # every statement goes through here, `query` is a registered `queries.Query`
+    async def _run(self, cur, query, values=None):
+        started = time.perf_counter()
+
+        try:
+            result = await cur.execute(query.sql, values)
+
+        except Exception:
+            self._record(cur, query, values, time.perf_counter() - started, failed=True)
+            raise
+
+        self._record(cur, query, values, time.perf_counter() - started)
+        return result
+
+    async def _run_many(self, cur, query, rows):
+        started = time.perf_counter()
+
+        try:
+            result = await cur.executemany(query.sql, rows)
+
+        except Exception:
+            self._record(cur, query, rows, time.perf_counter() - started, failed=True, many=True)
+            raise
+
+        self._record(cur, query, rows, time.perf_counter() - started, many=True)
+        return result
+
+    def _record(self, cur, query, values, elapsed, *, failed=False, many=False):
+        stats = self.statements.get(query.name)
+        if stats is None:
+            stats = self.statements[query.name] = StatementStats()
+
+        stats.latency.observe(elapsed)
+
+        # the first statement on a freshly acquired connection carries the wait for it
+        for pool in (self.pool, self.replica_pool):
+            wait = pool.take_wait(cur.connection) if pool is not None else None
+
+            if wait is not None:
+                stats.pool_wait.observe(wait)
+                break
+
+        if failed:
+            stats.errors += 1
+
+        # unbuffered cursors don't know their row count up front
+        elif 0 <= cur.rowcount < 2**63 - 1:
+            stats.rows += cur.rowcount
+
+            # more means a missing WHERE clause or a lost unique key (executemany counts the whole batch)
+            if query.rows is Q.Rows.One and not many and cur.rowcount > 1:
+                log.warning(
+                    StructuredMessage("statement expected to match one row", name=query.name, rows=cur.rowcount)
+                )
+
+        if elapsed >= self.slow_query_threshold:
+            stats.slow += 1
+            log.warning(
+                StructuredMessage(
+                    "slow query",
+                    name=query.name,
+                    seconds=round(elapsed, 4),
+                    params=f"{len(values)} rows" if many else _redact(values),
+                    sql=query.sql,
+                )
+            )
+
+    # (name, summary) for the `top` statements by total time spent in them, all if `top` is None
+    def query_stats(self, top=None):
+        ranked = sorted(self.statements.items(), key=lambda item: item[1].latency.total, reverse=True)
+
+        return [(name, stats.summary()) for (name, stats) in ranked[:top]]
+
+    def reset_query_stats(self):
+        self.statements.clear()
+
     async def _execute(self, query, values=None):
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                data = await cur.execute(query, values)
+                data = await self._run(cur, query, values)
 
         return data
 
     # Higher-level utility methods
 
+    # a User row changed, any `User` cached for it is dropped (the row still exists)
+    def _forget_user(self, user_id):
+        self._user_generations[user_id] += 1
+        self._known_users.set(user_id)
+
+    # the user's `User`, creating the row if needed; repeat users are answered from memory without a query
     async def ensure_user(self, user_id, *, create_locked=False):
-        created = await self.create_user(user_id, create_locked=create_locked)
-        user = await self.get_user_details(user_id)
+        user = self._known_users.get(user_id)
+        if user is not None:
+            return user
+
+        generation = self._user_generations[user_id]
+
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                if user_id not in self._known_users:
+                    await self._run(cur, Q.UPSERT_USER, (user_id, datetime.utcnow(), create_locked * 1))
+                    self._known_users.set(user_id)
+                    self._note_write(user_id)
+
+                await self._run(cur, Q.USER_DETAILS, (user_id,))
+
+                data = await cur.fetchall()
+
+        if data:
+            user = USER_DECODER.decode(data[0])
+
+            if self._user_generations[user_id] == generation:
+                self._known_users.set(user_id, user)
+
+            return user
 
-        return user
+    # makes sure every id has a User row, in chunked multi-row upserts; returns how many were created
+    async def ensure_users(self, user_ids, *, create_locked=False):
+        missing = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in self._known_users]
+
+        if not missing:
+            return 0
+
+        now = datetime.utcnow()
+        created = 0
+
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for start in range(0, len(missing), USER_BATCH_SIZE):
+                    chunk = missing[start : start + USER_BATCH_SIZE]
+
+                    await self._run_many(cur, Q.UPSERT_USER, [(user_id, now, create_locked * 1) for user_id in chunk])
+
+                    # with ON DUPLICATE KEY, untouched existing rows count as 0
+                    created += cur.rowcount
+
+                    for user_id in chunk:
+                        if user_id not in self._known_users:
+                            self._known_users.set(user_id)
+
+        return created
 
     # Currency methods
 
     async def get_currency_details(self, currency):
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute("SELECT * FROM Currency WHERE code = %s;", (currency.value,))
+                await self._run(cur, Q.CURRENCY_DETAILS, (currency.value,))
 
                 data = await cur.fetchall()
 
@@ -151,359 +641,671 @@ class SQL:
 
         raise RuntimeError(f"SELECT for currency {currency.value} has FAILED. This should not happen")
 
-    async def ensure_precise_amount(self, currency, amount, *, raise_on_fail=False):
-        (c_id, c_code, c_precision) = await self.get_currency_details(currency)
-        prec_verifier = Decimal(10) ** (-c_precision)  # this creates a decimal number with `c_precision` digits
+    # precision never changes at runtime, so the Currency table is only read at init (or on demand)
+    async def refresh_currencies(self):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await self._run(cur, Q.ALL_CURRENCIES)
+
+                data = await cur.fetchall()
+
+        currencies = {}
+        for (c_id, c_code, c_precision) in data:
+            try:
+                currency = CurrencyType(c_code)
+
+            except ValueError:
+                log.warning(f"Currency table has unknown code {c_code!r}, skipping")
+                continue
+
+            # this creates a decimal number with `c_precision` digits
+            currencies[currency] = CurrencyDetails(c_id, currency, c_precision, Decimal(10) ** (-c_precision))
+
+        self.currencies = currencies
+
+        return currencies
+
+    def get_currency(self, currency):
+        details = self.currencies.get(currency)
+
+        if details is None:
+            raise RuntimeError(f"Currency {currency.value} is not loaded. This should not happen")
+
+        return details
 
-        ctx = decimal.getcontext()
+    def ensure_precise_amount(self, currency, amount, *, raise_on_fail=False):
+        details = self.get_currency(currency)
+
+        # a private context per call, the flags on a shared one would race between tasks
+        ctx = d_context.copy()
         ctx.clear_flags()
 
         try:
             if amount.is_nan():
                 raise decimal.InvalidOperation
 
-            # this will set the Inexact flag if prec_verifier has fewer digits than amount
-            new_amount = amount.quantize(prec_verifier)
+            # this will set the Inexact flag if the quantizer has fewer digits than amount
+            new_amount = amount.quantize(details.quantizer, context=ctx)
 
         except decimal.InvalidOperation:
-            raise DecimalInvalidAmountError(amount, c_precision)
+            raise DecimalInvalidAmountError(amount, details.precision)
 
         if ctx.flags[decimal.Inexact]:
-            log.debug(f"Precision of {amount} does not match {c_precision}, clipping to {new_amount}")
-            ctx.clear_flags()
+            log.debug(
+                StructuredMessage("amount precision clipped", amount=amount, precision=details.precision, to=new_amount)
+            )
 
             if raise_on_fail:
-                raise DecimalPrecisionError(amount, c_precision, prec_verifier)
+                raise DecimalPrecisionError(amount, details.precision, details.quantizer)
 
         return new_amount
 
     # User methods
 
     async def get_user_details(self, user_id):
-        async with self.pool.acquire() as conn:
+        async with self._pool_for(Q.USER_DETAILS, user_id).acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute("SELECT * FROM User WHERE discordID = %s;", (user_id,))
+                await self._run(cur, Q.USER_DETAILS, (user_id,))
 
                 data = await cur.fetchall()
 
         if data:
-            (_id, timestamp, locked) = data[0]
-            return User(_id, timestamp, bool(locked))
+            return USER_DECODER.decode(data[0])
 
     async def create_user(self, user_id, *, create_locked=False):
+        self._note_write(user_id)
+
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                rows_changed = await cur.execute(
-                    dedent(
-                        """
-                        INSERT INTO `User` (discordID, createdAt, locked)
-                        VALUES (%s, NOW(), %s);
-                    """
-                    ),
-                    (user_id, create_locked * 1),
-                )
+                rows_changed = await self._run(cur, Q.CREATE_USER, (user_id, datetime.utcnow(), create_locked * 1))
+
+        self._forget_user(user_id)
 
         return rows_changed == 1
 
     async def lock_user(self, user_id):
+        self._note_write(user_id)
+
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        UPDATE User SET locked = 1 WHERE discordID = %s
-                        LIMIT 1;
-                    """
-                    ),
-                    user_id,
-                )
+                await self._run(cur, Q.LOCK_USER, user_id)
                 rows_changed = cur.rowcount
 
+        self._forget_user(user_id)
+
         return rows_changed == 1
 
     async def unlock_user(self, user_id):
+        self._note_write(user_id)
+
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        UPDATE User SET locked = 0 WHERE discordID = %s
-                        LIMIT 1;
-                    """
-                    ),
-                    user_id,
-                )
+                await self._run(cur, Q.UNLOCK_USER, user_id)
                 rows_changed = cur.rowcount
 
+        self._forget_user(user_id)
+
         return rows_changed == 1
 
     # LinkedAddress methods
 
+    # the other writes only know the address, not its currency, so every cached currency of the user goes
+    def _forget_addresses(self, user_id):
+        self._address_generations[user_id] += 1
+
+        for currency in CurrencyType:
+            self._addresses.pop((user_id, currency))
+
+    def _cached_address(self, user_id, currency):
+        entry = self._addresses.get((user_id, currency))
+
+        if entry is None or entry[0] <= time.monotonic():
+            return _MISSING
+
+        return entry[1]
+
+    # only stores `address` if the user's addresses haven't changed since `generation` was read
+    def _cache_address(self, user_id, currency, address, generation):
+        if self._address_generations[user_id] == generation:
+            self._addresses.set((user_id, currency), (time.monotonic() + ADDRESS_CACHE_TTL, address))
+
+    # cache fills read from the primary: a replica could hand back a row that was just changed and keep it cached
     async def get_address_for(self, user_id, currency):
+        cached = self._cached_address(user_id, currency)
+        if cached is not _MISSING:
+            return cached
+
+        generation = self._address_generations[user_id]
+
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        SELECT lA.address, lA.public, c.code FROM LinkedAddress lA, Currency c
-                        WHERE lA.userID = %s AND lA.currency = c.id AND c.code = %s
-                        LIMIT 1;
-                    """
-                    ),
-                    (user_id, currency.value),
-                )
+                await self._run(cur, Q.ADDRESS_FOR, (user_id, currency.value))
                 data = await cur.fetchall()
 
-        if data:
-            (address, is_public, code) = data[0]
-            return SavedAddress(address, bool(is_public), CurrencyType(code))
+        address = ADDRESS_DECODER.decode(data[0]) if data else None
+        self._cache_address(user_id, currency, address, generation)
+
+        return address
+
+    # user id -> SavedAddress (None if they have none) for every one of `user_ids`, in at most one query
+    async def get_addresses_for_users(self, user_ids, currency):
+        addresses = {}
+        missing = []
+
+        for user_id in user_ids:
+            cached = self._cached_address(user_id, currency)
+
+            if cached is _MISSING:
+                missing.append(user_id)
+
+            else:
+                addresses[user_id] = cached
+
+        if missing:
+            generations = {user_id: self._address_generations[user_id] for user_id in missing}
+
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await self._run(cur, Q.ADDRESSES_FOR_USERS, (missing, currency.value))
+                    data = await cur.fetchall()
+
+            found = {row[0]: USER_ADDRESS_DECODER.decode(row) for row in data}
+
+            for user_id in missing:
+                addresses[user_id] = found.get(user_id)
+                self._cache_address(user_id, currency, addresses[user_id], generations[user_id])
+
+        return addresses
 
     async def get_all_addresses(self, user_id):
-        async with self.pool.acquire() as conn:
+        async with self._pool_for(Q.ALL_ADDRESSES, user_id).acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        SELECT lA.address, lA.public, c.code FROM LinkedAddress lA, Currency c
-                        WHERE lA.userID = %s and lA.currency = c.id;
-                    """
-                    ),
-                    (user_id,),
-                )
+                await self._run(cur, Q.ALL_ADDRESSES, (user_id,))
                 data = await cur.fetchall()
 
         if data:
-            results = []
-            for (address, is_public, code) in data:
-                results.append(SavedAddress(address, bool(is_public), CurrencyType(code)))
+            return ADDRESS_DECODER.decode_all(data)
+
+    async def get_address_owners(self, addresses, *, include_private=False, user_id=None):
+        """Looks up who linked each of `addresses`.
+
+        Returns a dict of address -> list of `AddressOwner` (empty if nobody has it), only counting public
+        addresses unless `include_private` is set. `user_id` is whoever is asking, so their own recent
+        changes are seen.
+        """
 
-            return results
+        owners = {address: [] for address in addresses}
+        hashes = [hashlib.md5(address.encode()).digest() for address in owners]
+
+        async with self._pool_for(Q.ADDRESS_OWNERS, *_given(user_id)).acquire() as conn:
+            async with conn.cursor() as cur:
+                for start in range(0, len(hashes), ADDRESS_LOOKUP_BATCH_SIZE):
+                    await self._run(cur, Q.ADDRESS_OWNERS, (hashes[start : start + ADDRESS_LOOKUP_BATCH_SIZE],))
+
+                    for row in await cur.fetchall():
+                        saved = USER_ADDRESS_DECODER.decode(row)
+
+                        # the hash only narrows it down, a different address can share it
+                        if saved.address in owners and (include_private or saved.is_public):
+                            owners[saved.address].append(AddressOwner(row[0], saved))
+
+        return owners
 
     async def set_address_private(self, user_id, address):
-        async with self.pool.acquire() as con:
+        self._note_write(user_id)
+
+        async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        UPDATE LinkedAddress SET public = 0
-                        WHERE userID = %s AND address = %s;
-                    """
-                    ),
-                    (user_id, address),
-                )
+                await self._run(cur, Q.SET_ADDRESS_PRIVATE, (user_id, address))
                 rows_changed = cur.rowcount
 
+        self._forget_addresses(user_id)
+
         return rows_changed == 1
 
     async def set_address_public(self, user_id, address):
-        async with self.pool.acquire() as con:
+        self._note_write(user_id)
+
+        async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        UPDATE LinkedAddress SET public = 1
-                        WHERE userID = %s AND address = %s;
-                    """
-                    ),
-                    (user_id, address),
-                )
+                await self._run(cur, Q.SET_ADDRESS_PUBLIC, (user_id, address))
                 rows_changed = cur.rowcount
 
+        self._forget_addresses(user_id)
+
         return rows_changed == 1
 
     async def add_address_for(self, user_id, currency, address, *, create_private=False):
+        self._note_write(user_id)
+
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        INSERT INTO LinkedAddress (userID, currency, address, public)
-                        VALUES (%s, (SELECT id from Currency WHERE code = %s LIMIT 1), %s, %s);
-                    """
-                    ),
-                    (user_id, currency.value, address, create_private * 1),
-                )
+                await self._run(cur, Q.ADD_ADDRESS, (user_id, currency.value, address, (not create_private) * 1))
 
                 address_id = cur.lastrowid
 
+        self._address_generations[user_id] += 1
+        self._cache_address(
+            user_id, currency, SavedAddress(address, not create_private, currency), self._address_generations[user_id]
+        )
+
         return address_id
 
     async def delete_address_for(self, user_id, address):
-        async with pool.acquire() as conn:
+        self._note_write(user_id)
+
+        async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        DELETE FROM LinkedAddress
-                        WHERE userID = %s AND address = %s
-                        LIMIT 1;
-                    """
-                    ),
-                    (user_id, address),
-                )
+                await self._run(cur, Q.DELETE_ADDRESS, (user_id, address))
                 rows_changed = cur.rowcount
 
+        self._forget_addresses(user_id)
+
         return rows_changed == 1
 
     # EscrowPayment methods
 
-    async def get_payments(self, **kwargs):
-        raise UnimplementedError()
+    # turns keyword filters into a filled-in statement and its parameters
+    def _payment_query(
+        self,
+        query,
+        *,
+        sender_id=None,
+        receiver_id=None,
+        currency=None,
+        status=None,
+        since=None,
+        until=None,
+        before_id=None,
+        before_started=None,
+    ):
+        values = {}
+
+        if sender_id is not None:
+            values["sender_id"] = sender_id
+
+        if receiver_id is not None:
+            values["receiver_id"] = receiver_id
+
+        if currency is not None:
+            values["currency_id"] = self.get_currency(currency).id
+
+        if status is not None:
+            statuses = (status,) if isinstance(status, EscrowStatus) else status
+            values["statuses"] = tuple(s.value for s in statuses)
+
+        if since is not None:
+            values["since"] = since
+
+        if until is not None:
+            values["until"] = until
 
+        names = list(values)
+
+        # the date-ordered statements page on (startedAt, id), its fragment reads `before_id` as well
+        if before_started is not None:
+            values.update(before_started=before_started, before_id=before_id)
+            names.append("before_started")
+
+        elif before_id is not None:
+            values["before_id"] = before_id
+            names.append("before_id")
+
+        return (Q.with_filters(query, Q.PAYMENT_FILTERS, tuple(names)), values)
+
+    # by id, or by start date when filtering on it so the `started` key serves both the range and the order
+    @staticmethod
+    def _payment_listing(filters):
+        by_date = filters.get("since") is not None or filters.get("until") is not None
+
+        if not by_date and filters.get("before_started") is not None:
+            raise ValueError("before_started only applies to listings filtered by since/until")
+
+        if by_date and (filters.get("before_id") is None) != (filters.get("before_started") is None):
+            raise ValueError("listings filtered by since/until continue from before_started and before_id together")
+
+        return PAYMENTS_BY_DATE if by_date else PAYMENTS_BY_ID
+
+    @staticmethod
+    def _payment_users(filters):
+        return [filters[key] for key in ("sender_id", "receiver_id") if filters.get(key) is not None]
+
+    async def _payments_page(self, page_query, limit, filters):
+        query, values = self._payment_query(page_query, **filters)
+        values["limit"] = limit
+
+        async with self._pool_for(query, *self._payment_users(filters)).acquire() as conn:
+            async with conn.cursor() as cur:
+                await self._run(cur, query, values)
+                data = await cur.fetchall()
+
+        return PAYMENT_DECODER.decode_all(data)
+
+    # newest first; for the next page pass `before_id` as the id of the last payment returned
+    # filtered by `since` / `until` they're ordered by start date instead, and the next page also needs
+    # `before_started` as the last payment's `started_at`
+    # `include_archived` also searches archived payments, for history rather than anything still in play
+    async def get_payments(self, *, limit=50, include_archived=False, **filters):
+        listing = self._payment_listing(filters)
+        payments = await self._payments_page(listing.page, limit, filters)
+
+        if include_archived:
+            # hot table first: a payment archived in between shows up in both (deduplicated by id), never neither
+            archived = await self._payments_page(listing.archived_page, limit, filters)
+            merged = {payment.id: payment for payment in archived + payments}
+
+            payments = sorted(merged.values(), key=listing.key, reverse=True)[:limit]
+
+        return payments
+
+    # streams every matching payment through an unbuffered server-side cursor, `batch_size` rows at a time
+    # the connection is held until the generator is exhausted or closed, so aclose() it when stopping early
+    # with `include_archived`, archived payments follow the hot ones (each table newest first), a payment archived
+    # during the scan can be yielded twice
+    async def iter_payments(self, *, batch_size=500, include_archived=False, **filters):
+        listing = self._payment_listing(filters)
+        scans = (listing.scan, listing.archived_scan) if include_archived else (listing.scan,)
+
+        for scan in scans:
+            query, values = self._payment_query(scan, **filters)
+
+            async with self._pool_for(query, *self._payment_users(filters)).acquire() as conn:
+                async with conn.cursor(aiomysql.SSCursor) as cur:
+                    await self._run(cur, query, values)
+
+                    while True:
+                        data = await cur.fetchmany(batch_size)
+
+                        if not data:
+                            break
+
+                        for payment in PAYMENT_DECODER.decode_all(data):
+                            yield payment
+
+    # the activePair key makes the database the judge of "one active payment per pair", not a read beforehand
     async def create_payment(self, currency, sender_id, receiver_id, src_addr, dst_addr, amount, *, reason=None):
+        self._note_write(sender_id, receiver_id)
+
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        INSERT INTO EscrowPayment (currency, sender, receiver, sourceAddress, destAddress, status, amount, startedAt, forMessage)
-                        VALUES ((SELECT id FROM Currency WHERE code = %s), %s, %s, %s, %s, 'pending', %s, %s, %s)
-                    """
-                    ),
-                    (
-                        currency.value,
-                        sender_id,
-                        receiver_id,
-                        src_addr,
-                        dst_addr,
-                        amount,
-                        self.to_time_str_ms(datetime.utcnow()),
-                        reason,
-                    ),
-                )
+                try:
+                    await self._run(
+                        cur,
+                        Q.CREATE_PAYMENT,
+                        (
+                            currency.value,
+                            sender_id,
+                            receiver_id,
+                            src_addr,
+                            dst_addr,
+                            amount,
+                            datetime.utcnow(),
+                            reason,
+                        ),
+                    )
+
+                except aiomysql.IntegrityError as e:
+                    if e.args[0] == ER_DUP_ENTRY:
+                        raise ActivePaymentExistsError(sender_id, receiver_id) from e
+
+                    raise
 
                 payment_id = cur.lastrowid
 
         return payment_id
 
     async def get_active_payment_by_participants(self, sender_id, receiver_id):
-        async with self.pool.acquire() as conn:
+        async with self._pool_for(Q.ACTIVE_PAYMENT_BY_PARTICIPANTS, sender_id, receiver_id).acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        SELECT E.*, C.code FROM EscrowPayment E, Currency C
-                        WHERE E.sender = %s AND E.receiver = %s
-                        AND E.status != 'complete' AND E.status != 'failed'
-                        AND C.id = E.currency
-                        LIMIT 1;
-                    """
-                    ),
-                    (sender_id, receiver_id),
-                )
+                await self._run(cur, Q.ACTIVE_PAYMENT_BY_PARTICIPANTS, (sender_id, receiver_id))
                 data = await cur.fetchall()
 
-        # Do proper data conversions so everything comes out polished
         if data:
-            (
-                _id,
-                currency_id,
-                sender_id,
-                receiver_id,
-                src_addr,
-                dst_addr,
-                status,
-                amount,
-                started_at,
-                for_message,
-                last_action_at,
-                currency_code,
-            ) = data[0]
-            return EscrowPayment(
-                _id,
-                CurrencyType(currency_code),
-                sender_id,
-                receiver_id,
-                src_addr,
-                dst_addr,
-                EscrowStatus(status),
-                amount,
-                started_at,
-                for_message,
-                last_action_at if isinstance(last_action_at, datetime) else None,
-            )
+            return PAYMENT_DECODER.decode(data[0])
+
+    # with `expected`, the update only lands if the payment is still in one of those statuses
+    async def update_payment_status(self, payment_id, status, *, expected=None):
+        query = Q.UPDATE_PAYMENT_STATUS
+        values = (status.value, datetime.utcnow(), payment_id)
+
+        if expected is not None:
+            query = Q.UPDATE_PAYMENT_STATUS_IF
+            values += (tuple(s.value for s in expected),)
 
-    async def update_payment_status(self, payment_id, status):
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        UPDATE EscrowPayment SET status = %s, lastActionAt = %s
-                        WHERE id = %s;
-                    """
-                    ),
-                    (status.value, self.to_time_str_ms(datetime.utcnow()), payment_id),
-                )
+                await self._run(cur, query, values)
 
                 rows_changed = cur.rowcount
 
         return rows_changed == 1
 
-    # EscrowEvent methods
+    # writes the event and the status change in one transaction, so a payment can't end up with only one of them
+    async def transition_payment(
+        self, payment_id, status, action, actioner, actioner_id, *, expected=None, message=None
+    ):
+        now = datetime.utcnow()
+
+        query = Q.UPDATE_PAYMENT_STATUS
+        values = (status.value, now, payment_id)
+
+        if expected is not None:
+            query = Q.UPDATE_PAYMENT_STATUS_IF
+            values += (tuple(s.value for s in expected),)
+
+        self._note_write(actioner_id)
 
-    async def get_payment_event(self, payment_id):
         async with self.pool.acquire() as conn:
+            await conn.begin()
+
+            try:
+                async with conn.cursor() as cur:
+                    # status first, so a lost compare-and-set never writes an event
+                    await self._run(cur, query, values)
+                    did_update = cur.rowcount == 1
+
+                    did_report = did_update and await self._insert_payment_event(
+                        cur, payment_id, action, actioner, actioner_id, now, message
+                    )
+
+                if not (did_report and did_update):
+                    await conn.rollback()
+                    return False
+
+                await conn.commit()
+
+            except:
+                await conn.rollback()
+                raise
+
+        return True
+
+    # compare-and-set on the active payment between two users, without reading it first
+    async def transition_active_payment(
+        self, sender_id, receiver_id, status, action, actioner, actioner_id, *, expected=ACTIVE_STATUSES, message=None
+    ):
+        now = datetime.utcnow()
+
+        self._note_write(sender_id, receiver_id, actioner_id)
+
+        async with self.pool.acquire() as conn:
+            await conn.begin()
+
+            try:
+                async with conn.cursor() as cur:
+                    await self._run(
+                        cur,
+                        Q.UPDATE_ACTIVE_PAYMENT_STATUS_IF,
+                        (status.value, now, sender_id, receiver_id, tuple(s.value for s in expected)),
+                    )
+
+                    if cur.rowcount != 1:
+                        await conn.rollback()
+
+                        # cold path: find out why, so the caller can explain it
+                        await self._run(cur, Q.ACTIVE_PAYMENT_BY_PARTICIPANTS, (sender_id, receiver_id))
+                        data = await cur.fetchall()
+
+                        return PaymentTransition(PAYMENT_DECODER.decode(data[0]) if data else None, False)
+
+                    payment_id = cur.lastrowid
+
+                    if not await self._insert_payment_event(
+                        cur, payment_id, action, actioner, actioner_id, now, message
+                    ):
+                        raise RuntimeError(f"could not write payment event for {payment_id}")
+
+                    await self._run(cur, Q.PAYMENT_BY_ID, (payment_id,))
+                    data = await cur.fetchall()
+
+                await conn.commit()
+
+            except:
+                await conn.rollback()
+                raise
+
+        return PaymentTransition(PAYMENT_DECODER.decode(data[0]), True)
+
+    # Archival
+
+    # moves one batch of finished payments older than `cutoff` into the archive, returns how many moved
+    async def _archive_batch(self, cutoff, batch_size):
+        async with self.pool.acquire() as conn:
+            await conn.begin()
+
+            try:
+                async with conn.cursor() as cur:
+                    await self._run(cur, Q.ARCHIVABLE_PAYMENTS, (cutoff, batch_size))
+                    payment_ids = [row[0] for row in await cur.fetchall()]
+
+                    if payment_ids:
+                        await self._run(cur, Q.ARCHIVE_PAYMENTS, (payment_ids,))
+                        await self._run(cur, Q.DELETE_ARCHIVED_PAYMENTS, (payment_ids,))
+
+                await conn.commit()
+
+            except:
+                await conn.rollback()
+                raise
+
+        return len(payment_ids)
+
+    # small transactions with a pause in between, so the hot table is never locked for long
+    async def archive_payments(self, *, older_than=None, batch_size=None):
+        cutoff = datetime.utcnow() - (self.archive_after if older_than is None else older_than)
+        batch_size = batch_size or self.archive_batch_size
+        moved = 0
+
+        while True:
+            batch = await self._archive_batch(cutoff, batch_size)
+            moved += batch
+            self.archived += batch
+
+            if batch < batch_size:
+                break
+
+            await asyncio.sleep(self.archive_pause)
+
+        return moved
+
+    async def _archive_loop(self):
+        while True:
+            try:
+                started = time.perf_counter()
+                moved = await self.archive_payments()
+
+                if moved:
+                    log.info("Archived %d finished payments in %.1fs", moved, time.perf_counter() - started)
+
+            except Exception as e:
+                log.warning("Could not archive payments: [%s]: %s", type(e).__name__, e)
+
+            await asyncio.sleep(self.archive_interval)
+
+    # EscrowEvent methods
+    # reads take an optional `user_id` of whoever is reading, so their own recent actions are visible (see `_pool_for`)
+
+    # the latest event of a payment
+    async def get_payment_event(self, payment_id, *, user_id=None):
+        async with self._pool_for(Q.PAYMENT_EVENT, *_given(user_id)).acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        SELECT * FROM EscrowEvent WHERE paymentID = %s LIMIT 1;
-                    """
-                    ),
-                    (payment_id,),
-                )
-                data = cur.fetchall()
+                await self._run(cur, Q.PAYMENT_EVENT, (payment_id,))
+                data = await cur.fetchall()
 
         if data:
-            (_id, action, actioner, actioner_id, action_at, action_msg) = data[0]
-            return EscrowEvent(_id, EscrowAction(action), EscrowActioner(actioner), actioner_id, action_at, action_msg)
+            return EVENT_DECODER.decode(data[0])
+
+    # every event of a payment, oldest first
+    async def get_payment_history(self, payment_id, *, user_id=None):
+        async with self._pool_for(Q.PAYMENT_HISTORY, *_given(user_id)).acquire() as conn:
+            async with conn.cursor() as cur:
+                await self._run(cur, Q.PAYMENT_HISTORY, (payment_id,))
+                data = await cur.fetchall()
+
+        return EVENT_DECODER.decode_all(data)
+
+    # payment id -> its events oldest first (empty if it has none), for every one of `payment_ids`
+    async def get_histories(self, payment_ids, *, user_id=None):
+        histories = {payment_id: [] for payment_id in payment_ids}
+        ids = list(histories)
+
+        async with self._pool_for(Q.PAYMENT_HISTORIES, *_given(user_id)).acquire() as conn:
+            async with conn.cursor() as cur:
+                for start in range(0, len(ids), HISTORY_BATCH_SIZE):
+                    await self._run(cur, Q.PAYMENT_HISTORIES, (ids[start : start + HISTORY_BATCH_SIZE],))
+
+                    for event in EVENT_DECODER.decode_all(await cur.fetchall()):
+                        histories[event.payment_id].append(event)
+
+        return histories
 
     async def create_payment_event(self, payment_id, action, actioner, actioner_id, *, message=None):
+        self._note_write(actioner_id)
+
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        INSERT INTO EscrowEvent (paymentID, action, actioner, actionerID, actionAt, actionMsg)
-                        VALUES (%s, %s, %s, %s, %s, %s);
-                    """
-                    ),
-                    (
-                        payment_id,
-                        action.value,
-                        actioner.value,
-                        actioner_id,
-                        self.to_time_str_ms(datetime.utcnow()),
-                        message,
-                    ),
+                did_report = await self._insert_payment_event(
+                    cur, payment_id, action, actioner, actioner_id, datetime.utcnow(), message
                 )
-                rows_changed = cur.rowcount
 
-        return rows_changed == 1
+        return did_report
+
+    # shared by the single-event and transition paths, runs on the caller's cursor
+    async def _insert_payment_event(self, cur, payment_id, action, actioner, actioner_id, action_at, message):
+        await self._run(
+            cur, Q.CREATE_PAYMENT_EVENT, (payment_id, action.value, actioner.value, actioner_id, action_at, message)
+        )
+
+        return cur.rowcount == 1
 
     # just for database error logging
     async def create_error_report(self, report):
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    dedent(
-                        """
-                        INSERT INTO LoggedErrors (`level`, module, function, filename, lineno, message, `timestamp`)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s);
-                    """
-                    ),
+                await self._run(
+                    cur,
+                    Q.CREATE_ERROR_REPORT,
                     (
-                        report.levelName,
+                        report.levelname,
                         report.module,
                         report.funcName,
                         report.filename,
                         report.lineno,
                         report.getMessage(),
-                        self.to_time_str(datetime.fromtimestamp(report.created)),
+                        datetime.fromtimestamp(report.created),
                     ),
                 )
 
                 report_id = cur.lastrowid
 
         return report_id
+
+    # `reports` are (level, module, function, filename, lineno, message, timestamp) tuples, written as one statement
+    async def create_error_reports(self, reports):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await self._run_many(cur, Q.CREATE_ERROR_REPORT, reports)
+
+                rows_changed = cur.rowcount
+
+        return rows_changed
@@ -2,16 +2,22 @@
 #
 # Copyright (c) 2021 Mieszko Exchange
 
-__all__ = "prepare_logger", "get_logger", "set_level", "set_database"
+__all__ = "prepare_logger", "get_logger", "set_level", "set_database", "StructuredMessage"
 
 import asyncio
-import inspect
+import atexit
+import copy
+import gzip
 import logging
 import os
+import queue
+import shutil
 import sys
 from datetime import datetime
 from logging import Handler, handlers
 
+from . import config
+
 # Make sure the log directory exists (and create it if not)
 if not os.path.exists("logs"):
     os.makedirs("logs")
@@ -20,23 +26,203 @@ _DEBUG = any(arg.lower() == "debug" for arg in sys.argv)
 
 LOG_LEVEL = logging.DEBUG if _DEBUG else logging.INFO
 
+_CONFIG = config.read("./config.toml").get("Logging", {})
+
+# queued by `DatabaseErrorHandler.stop`, the writer exits once it gets to it
+_STOP = object()
+
 
 class DatabaseErrorHandler(Handler):
-    def __init__(self, db):
+    """Queues ERROR records and writes them to the database in batches from a single background task.
+
+    The queue is bounded: once it's full, new records are dropped (and counted) rather than piling up
+    tasks or memory, so a failing database can't turn error logging into a second outage.
+    """
+
+    def __init__(self, db, *, max_queued=1000, batch_size=50, flush_interval=5.0):
         self.db = db
         self.loop = asyncio.get_event_loop()
 
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.queue = asyncio.Queue(maxsize=max_queued)
+
+        # counters, see `stats`
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._stopping = False
+        self.__writer = self.loop.create_task(self._write_loop())
+
         super().__init__(logging.ERROR)
 
     def emit(self, record):
-        self.loop.create_task(self.db.create_error_report(record))
+        # capture everything now, the writer may only get to it seconds later
+        report = (
+            record.levelname,
+            record.module,
+            record.funcName,
+            record.filename,
+            record.lineno,
+            record.getMessage()[:1000],  # LoggedError.message is a varchar(1000)
+            datetime.fromtimestamp(record.created),
+        )
+
+        try:
+            self.loop.call_soon_threadsafe(self._enqueue, report)
+
+        except RuntimeError:  # loop is closed
+            self.dropped += 1
+
+    def _enqueue(self, report):
+        try:
+            self.queue.put_nowait(report)
+
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    # waits for one report, then gathers more until the batch is full or `flush_interval` has passed
+    # stops early at the `_STOP` marker, the batch is whatever came before it
+    async def _next_batch(self):
+        batch = []
+        deadline = None
+
+        while len(batch) < self.batch_size:
+            if deadline is None:
+                report = await self.queue.get()
+                deadline = self.loop.time() + self.flush_interval
+
+            else:
+                timeout = deadline - self.loop.time()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    report = await asyncio.wait_for(self.queue.get(), timeout)
+
+                except asyncio.TimeoutError:
+                    break
+
+            if report is _STOP:
+                self._stopping = True
+                break
+
+            batch.append(report)
+
+        return batch
+
+    async def _write(self, batch):
+        try:
+            await self.db.create_error_reports(batch)
+
+        except Exception as e:
+            # not logged, that would only feed more records back into this handler
+            self.failed += len(batch)
+            print(f"[{type(e).__name__}]: could not write {len(batch)} error reports: {e}", file=sys.stderr)
+
+        else:
+            self.written += len(batch)
+
+    async def _write_loop(self):
+        await self.db.wait_until_ready()
+
+        while not self._stopping:
+            batch = await self._next_batch()
+
+            if batch:
+                await self._write(batch)
+
+    # stop the writer and write out whatever is still queued (call before closing the database)
+    async def stop(self):
+        if not self.__writer.done():
+            if self.db.is_ready:
+                # queued behind everything already waiting, so a batch being written is never cut off halfway
+                await self.queue.put(_STOP)
+                await self.__writer
+
+            else:
+                # still waiting for the database, nothing is in flight
+                self.__writer.cancel()
+
+        batch = []
+        while not self.queue.empty():
+            report = self.queue.get_nowait()
+
+            if report is not _STOP:
+                batch.append(report)
+
+        if batch:
+            await self._write(batch)
+
+    def stats(self):
+        return dict(queued=self.queue.qsize(), written=self.written, dropped=self.dropped, failed=self.failed)
+
+
+class StructuredMessage:
+    """A `message key=value ...` log payload that is only formatted if a handler actually emits it.
+
+    Use it as the log message, e.g. `log.debug(StructuredMessage("sent", route=route, status=status))`.
+    The raw `fields` stay available on the object for anything that wants them unformatted.
+    """
+
+    __slots__ = ("message", "fields")
+
+    def __init__(self, message, **fields):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self):
+        if not self.fields:
+            return self.message
+
+        return f"{self.message} | {' '.join(f'{key}={value!r}' for (key, value) in self.fields.items())}"
+
+
+class QueueHandler(handlers.QueueHandler):
+    """Hands records to the writer thread, only resolving what can't safely cross threads.
+
+    The stdlib version runs a full `Formatter` pass on the calling thread, here the real formatting
+    (timestamps, layout) is left to `FILE_HANDLER` on the writer thread.
+    """
+
+    def prepare(self, record):
+        # other handlers (the database one) get the same record, so only the copy is flattened
+        record = copy.copy(record)
+
+        # args may be mutated after the call returns, and exc_info keeps whole frames alive
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = LOG_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+def _gzip_namer(name):
+    return f"{name}.gz"
+
+
+# runs on the writer thread, so compressing never holds up the event loop
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+
+    os.remove(source)
 
 
 # Handlers
 DATABASE_HANDLER = None  # must be setup on init
 FILE_HANDLER = handlers.RotatingFileHandler(
-    filename="logs/medb.log", maxBytes=1 * 1024 * 1024, backupCount=3
-)  # Max size of 1MiB per-file, with 3 past files
+    filename="logs/medb.log",
+    maxBytes=_CONFIG.get("max_bytes", 1 * 1024 * 1024),
+    backupCount=_CONFIG.get("backup_count", 3),
+    delay=True,
+)  # defaults to a max size of 1MiB per-file, with 3 past files
 LOG_FORMATTER = logging.Formatter(
     "%(asctime)s %(levelname)s | [module %(module)s -> function %(funcName)s] (%(filename)s:%(lineno)s) | %(message)s"
 )
@@ -44,6 +230,25 @@ LOG_FORMATTER = logging.Formatter(
 FILE_HANDLER.setLevel(logging.NOTSET)
 FILE_HANDLER.setFormatter(LOG_FORMATTER)
 
+if _CONFIG.get("compress", True):
+    FILE_HANDLER.namer = _gzip_namer
+    FILE_HANDLER.rotator = _gzip_rotator
+
+# Loggers only enqueue, a dedicated thread formats, writes and rotates
+LOG_QUEUE = queue.SimpleQueue()
+QUEUE_HANDLER = QueueHandler(LOG_QUEUE)
+LOG_LISTENER = handlers.QueueListener(LOG_QUEUE, FILE_HANDLER, respect_handler_level=True)
+
+
+# flush and stop the writer thread, safe to call more than once
+def stop_listener():
+    if LOG_LISTENER._thread is not None:
+        LOG_LISTENER.stop()
+
+
+LOG_LISTENER.start()
+atexit.register(stop_listener)
+
 # Set log level according to debug status (call once at init)
 def set_level(debug=False):
     global LOG_LEVEL
@@ -58,33 +263,28 @@ def set_database(db):
     DATABASE_HANDLER = DatabaseErrorHandler(db)
 
 
-# Special logger that runs for each module it's called in
-def get_logger():
-    # Get name of calling module
-    call_frame = inspect.stack()[1]
-    call_module = inspect.getmodule(call_frame[0])
-    module_name = call_module.__name__
-
-    # Setup custom FileHandler logger
-    module_logger = logging.getLogger(module_name)
+# add our handlers once, so re-running get_logger (cog reloads) doesn't duplicate output
+def _attach_handlers(module_logger):
     module_logger.setLevel(LOG_LEVEL)
-    module_logger.addHandler(FILE_HANDLER)
 
-    if DATABASE_HANDLER is not None:
-        module_logger.addHandler(DATABASE_HANDLER)
+    if QUEUE_HANDLER not in module_logger.handlers:
+        module_logger.addHandler(QUEUE_HANDLER)
 
-    # don't leak stack frames, kthx
-    del call_frame
-    del call_module
+    if DATABASE_HANDLER is not None and DATABASE_HANDLER not in module_logger.handlers:
+        module_logger.addHandler(DATABASE_HANDLER)
 
     return module_logger
 
 
+# Special logger that runs for each module it's called in
+def get_logger(name=None):
+    if name is None:
+        # Get name of calling module, its globals are all we need (no stack records or source lines)
+        name = sys._getframe(1).f_globals.get("__name__", "__main__")
+
+    return _attach_handlers(logging.getLogger(name))
+
+
 # manual method for injecting our handler to pre-existing loggers
 def prepare_logger(log_name):
-    module_logger = logging.getLogger(log_name)
-    module_logger.setLevel(LOG_LEVEL)
-    module_logger.addHandler(FILE_HANDLER)
-
-    if DATABASE_HANDLER is not None:
-        module_logger.addHandler(DATABASE_HANDLER)
+    _attach_handlers(logging.getLogger(log_name))
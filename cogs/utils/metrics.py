@@ -0,0 +1,69 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2021 Mieszko Exchange
+
+# Cheap in-process metrics, read back through owner commands
+
+__all__ = ("Histogram", "LATENCY_BUCKETS")
+
+from bisect import bisect_left
+
+# upper bounds in seconds, roughly 2.5x apart, from sub-millisecond up to "something is badly wrong"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Counts observations into fixed buckets, so recording is O(log buckets) and memory never grows."""
+
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        # one extra bucket for everything above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    # upper bound of the bucket holding the q-th quantile, the largest value seen for the overflow bucket
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for (index, bucket_count) in enumerate(self.counts):
+            seen += bucket_count
+
+            if seen >= rank:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+
+        return self.max
+
+    def summary(self):
+        return dict(
+            count=self.count,
+            mean=self.mean,
+            p50=self.quantile(0.5),
+            p95=self.quantile(0.95),
+            p99=self.quantile(0.99),
+            max=self.max,
+        )
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
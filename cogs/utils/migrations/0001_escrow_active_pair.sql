@@ -0,0 +1,21 @@
+-- The MIT License (MIT)
+--
+-- Copyright (c) 2021 Mieszko Exchange
+
+-- Brings an existing EscrowPayment table in line with schema.sql: an indexed `active` flag,
+-- and at most one active payment per sender/receiver pair.
+
+-- Pairs listed here already have more than one active payment and must be settled by hand first,
+-- or adding activePair will fail with a duplicate key error.
+SELECT sender, receiver, COUNT(*) AS activePayments FROM EscrowPayment
+WHERE status IN ('pending', 'paid')
+GROUP BY sender, receiver
+HAVING COUNT(*) > 1;
+
+ALTER TABLE EscrowPayment
+    ADD COLUMN active tinyint(1) unsigned AS (IF(status IN ('pending', 'paid'), 1, NULL)) STORED AFTER lastActionAt,
+    ADD UNIQUE KEY activePair (sender, receiver, active);
+
+-- activePair has (sender, receiver) as its prefix, so the old KEY(sender, receiver) is redundant.
+-- MySQL named it after its first column when the table was created.
+ALTER TABLE EscrowPayment DROP KEY sender;
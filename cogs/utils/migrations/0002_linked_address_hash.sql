@@ -0,0 +1,13 @@
+-- The MIT License (MIT)
+--
+-- Copyright (c) 2021 Mieszko Exchange
+
+-- Brings an existing LinkedAddress table in line with schema.sql: reverse lookups by address go through
+-- a 16 byte hash of it instead of an index on the full varchar(256).
+
+ALTER TABLE LinkedAddress
+    ADD COLUMN addressHash binary(16) AS (UNHEX(MD5(address))) STORED AFTER public,
+    ADD KEY addressHash (addressHash);
+
+-- Nothing else looks rows up by address alone, every other statement has the userID primary key prefix.
+ALTER TABLE LinkedAddress DROP KEY address;
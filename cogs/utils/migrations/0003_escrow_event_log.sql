@@ -0,0 +1,18 @@
+-- The MIT License (MIT)
+--
+-- Copyright (c) 2021 Mieszko Exchange
+
+-- Brings an existing EscrowEvent table in line with schema.sql: events get their own id, so a payment can
+-- have any number of them, and paymentTimeline serves per-payment history in time order.
+-- Existing rows are numbered in primary key order, i.e. by paymentID.
+
+ALTER TABLE EscrowEvent
+    MODIFY paymentID bigint unsigned NOT NULL,
+    DROP PRIMARY KEY,
+    ADD COLUMN id serial FIRST,
+    ADD PRIMARY KEY (id),
+    ADD KEY paymentTimeline (paymentID, actionAt);
+
+-- `paymentID serial` also created a UNIQUE key named after the column, which would still allow only one
+-- event per payment. paymentTimeline now backs the foreign key in its place.
+ALTER TABLE EscrowEvent DROP KEY paymentID;
@@ -0,0 +1,27 @@
+-- The MIT License (MIT)
+--
+-- Copyright (c) 2021 Mieszko Exchange
+
+-- Brings an existing database in line with schema.sql: finished payments can be moved out of EscrowPayment
+-- into EscrowPaymentArchive by the archival job.
+
+ALTER TABLE EscrowPayment ADD KEY finished (active, lastActionAt);
+
+CREATE TABLE EscrowPaymentArchive LIKE EscrowPayment;
+
+-- LIKE copies the generated column and the keys only the hot table needs
+ALTER TABLE EscrowPaymentArchive
+    DROP KEY activePair,
+    DROP KEY finished,
+    MODIFY id bigint unsigned NOT NULL,
+    MODIFY active tinyint(1) unsigned DEFAULT NULL;
+
+-- LIKE doesn't copy foreign keys
+ALTER TABLE EscrowPaymentArchive
+    ADD FOREIGN KEY (currency) REFERENCES Currency (id) ON UPDATE CASCADE,
+    ADD FOREIGN KEY (sender) REFERENCES User (discordID) ON UPDATE CASCADE,
+    ADD FOREIGN KEY (receiver) REFERENCES User (discordID) ON UPDATE CASCADE;
+
+-- Events outlive the move, so they can't cascade from (or be pinned to) EscrowPayment anymore.
+-- The constraint name is generated, check `SHOW CREATE TABLE EscrowEvent` if this one doesn't exist.
+ALTER TABLE EscrowEvent DROP FOREIGN KEY EscrowEvent_ibfk_1;
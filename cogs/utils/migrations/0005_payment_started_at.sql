@@ -0,0 +1,10 @@
+-- The MIT License (MIT)
+--
+-- Copyright (c) 2021 Mieszko Exchange
+
+-- Brings an existing database in line with schema.sql: payment listings filtered by start date (`since` / `until`)
+-- can range scan both payment tables instead of reading them whole.
+
+ALTER TABLE EscrowPayment ADD KEY started (startedAt, id);
+
+ALTER TABLE EscrowPaymentArchive ADD KEY started (startedAt, id);
@@ -0,0 +1,10 @@
+-- The MIT License (MIT)
+--
+-- Copyright (c) 2021 Mieszko Exchange
+
+-- Repairs LinkedAddress rows saved before the ADD_ADDRESS fix: it bound `create_private` into the `public` column,
+-- so every address was stored with its flag inverted (the ones users asked to keep private were made public).
+-- Until then ADD_ADDRESS was the only statement that wrote `public`, the set public/private methods never ran,
+-- so flipping every row is exact. Run it once, on the release that ships the fix, before `whois` is used.
+
+UPDATE LinkedAddress SET public = 1 - public;
@@ -4,35 +4,100 @@
 
 # Direct REST client for the Mieszko Exchange Payments API
 
-__all__ = "ApiResponseError", "CurrencyType", "PaymentClient"
+__all__ = (
+    "ApiResponseError",
+    "InvalidResponseError",
+    "CurrencyType",
+    "Balance",
+    "PaymentRequest",
+    "SentPayment",
+    "PaymentClient",
+    "RateLimitExceeded",
+)
 
 import asyncio
+import decimal
 import json
+import math
+import random
 import sys
+import time
+import uuid
+from collections import Counter
 from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from decimal import Decimal
+from email.utils import parsedate_to_datetime
 from enum import Enum
+from functools import partial
 from textwrap import indent
 from typing import Optional
 
 import aiohttp
 
 from . import config
-from .logger import get_logger
+from .cache import TTLCache
+from .logger import StructuredMessage, get_logger
+from .metrics import Histogram
+from .ratelimit import RateLimitExceeded, TokenBucket
+from .records import Record, RowDecoder, lookup_table
+
+# non-integer numbers go straight to Decimal, amounts never pass through binary floating point
+json_loads = partial(json.loads, parse_float=Decimal)
 
 log = get_logger()
 
 API_ROOT = config.read("./config.toml")["Exchange"]["api_root"]
 
+# connection pool defaults, overridable in the [Exchange.Connection] config
+CONNECTION_LIMIT = 20  # open connections across all hosts
+CONNECTION_LIMIT_PER_HOST = 10  # everything goes to API_ROOT, so this is the one that matters
+KEEPALIVE_TIMEOUT = 30.0  # seconds an idle connection is kept for reuse
+DNS_TTL = 300  # seconds a resolved API_ROOT host is cached
+CONNECT_TIMEOUT = 5.0  # seconds to get a connection (pool wait included)
+REQUEST_TIMEOUT = 30.0  # seconds for a whole request, response body included
+
+# retry defaults, overridable in the [Exchange.Retry] config
+RETRY_ATTEMPTS = 4  # tries per request, the first one included
+RETRY_BASE_DELAY = 0.25  # seconds, doubled every retry
+RETRY_MAX_DELAY = 5.0  # seconds, the most a single backoff can grow to
+
+# seconds a balance is served from cache, overridable as `balance_ttl` in [Exchange]
+BALANCE_TTL = 5.0
+
+# rate limit defaults per route, overridable in the [Exchange.RateLimit] config
+RATE_LIMIT_RATE = 5.0  # requests per second
+RATE_LIMIT_BURST = 10  # requests at once
+RATE_LIMIT_MAX_WAIT = 10.0  # seconds a request may queue before it's failed instead
+RETRY_AFTER_DEFAULT = 1.0  # seconds to back off for a 429 without a usable Retry-After
+
+# gateway errors: the exchange may or may not have acted on the request
+RETRY_STATUSES = {502, 503, 504}
+# rate limited: the request was turned away before anything happened
+TOO_MANY_REQUESTS = 429
+
 
 class ApiResponseError(Exception):
     """Raised when the payments API returns an error response."""
 
-    def __init__(self, status: int, message: str):
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
         self.status = status
         self.message = str(message)
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return f"{self.__class__.__name__}: HTTP {self.status}\n{indent(self.message, '  ')}"
+
+
+class InvalidResponseError(Exception):
+    """Raised when a successful response doesn't have the shape its route promises."""
+
+    def __init__(self, path: str, reason: str):
+        self.path = path
+        self.reason = reason
 
     def __str__(self):
-        return f"{self.__class__.__name__}: HTTP {self.status}\n{textwrap.indent(self.message, '  ')}"
+        return f"{self.__class__.__name__}: unexpected response from {self.path}: {self.reason}"
 
 
 class CurrencyType(Enum):
@@ -41,111 +106,438 @@ class CurrencyType(Enum):
     Bitcoin = "BTC"
 
 
+# Response models, fields are named like the request payloads that produce them
+class Balance(Record):
+    __slots__ = ("currency", "amount")
+
+
+class PaymentRequest(Record):
+    __slots__ = ("id", "currency", "amount", "address")
+
+
+class SentPayment(Record):
+    __slots__ = ("id", "currency", "amount", "address")
+
+
+# amounts arrive as numeric strings or JSON numbers, the latter already parsed to int or Decimal by `json_loads`
+def _amount(value):
+    if isinstance(value, bool) or not isinstance(value, (str, int, Decimal)):
+        raise TypeError(f"amount must be a number or numeric string, not {type(value).__name__}")
+
+    return Decimal(value)
+
+
+_currency_lookup = lookup_table(CurrencyType)
+
+
+# an unknown code is a bad value, not a missing field
+def _currency_type(value):
+    try:
+        return _currency_lookup(value)
+
+    except KeyError:
+        raise ValueError(f"unknown currency {value!r}") from None
+
+
+BALANCE_DECODER = RowDecoder(Balance, currency=("currency", _currency_type), amount=("amount", _amount))
+
+PAYMENT_REQUEST_DECODER = RowDecoder(
+    PaymentRequest,
+    id="id",
+    currency=("currency", _currency_type),
+    amount=("amount", _amount),
+    address="receiveAddress",
+)
+
+SENT_PAYMENT_DECODER = RowDecoder(
+    SentPayment,
+    id="id",
+    currency=("currency", _currency_type),
+    amount=("amount", _amount),
+    address="receiveAddress",
+)
+
+
 @dataclass
 class Route:
     method: str
     path: str
+    # repeating the request can't change anything on the exchange, so it's always safe to retry
+    idempotent: bool = False
+    # turns a successful JSON response into its model, raw data is returned without one
+    decoder: Optional[RowDecoder] = None
+    # money has moved once the exchange answers 2xx, so a response that doesn't decode is returned raw (and logged)
+    # rather than raised as if the request had failed
+    moves_money: bool = False
     url: str = field(init=False)
 
     def __post_init__(self):
         self.url = f"{API_ROOT}/{self.path}"
 
 
+@dataclass
+class RetryPolicy:
+    attempts: int = RETRY_ATTEMPTS
+    base_delay: float = RETRY_BASE_DELAY
+    max_delay: float = RETRY_MAX_DELAY
+
+    # "full jitter": anywhere up to the exponential backoff, so retrying clients don't move in lockstep
+    def delay(self, retry):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry - 1)))
+
+
+class RouteStats:
+    """Request counters and per-attempt latency for one route."""
+
+    __slots__ = ("latency", "counts")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.counts = Counter()
+
+    def summary(self):
+        return dict(self.counts, **{f"latency_{key}": value for (key, value) in self.latency.summary().items()})
+
+
+# Retry-After is either a number of seconds or an HTTP date
+def parse_retry_after(value):
+    if value is None:
+        return None
+
+    try:
+        seconds = float(value)
+
+    except ValueError:
+        pass
+
+    else:
+        # "inf" / "nan" parse as floats, but would pause the route forever (or not at all)
+        return max(0.0, seconds) if math.isfinite(seconds) else None
+
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+
+    except (TypeError, ValueError):
+        return None
+
+
+# whether a failed attempt can be tried again, `repeatable` if the exchange would not act on it twice
+def should_retry(error, repeatable):
+    # the connection was never made, so the exchange never saw the request
+    if isinstance(error, aiohttp.ClientConnectorError):
+        return True
+
+    if isinstance(error, ApiResponseError):
+        return error.status == TOO_MANY_REQUESTS or (repeatable and error.status in RETRY_STATUSES)
+
+    # timeouts and dropped connections leave it unknown whether the request went through
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError)):
+        return repeatable
+
+    return False
+
+
 class PaymentClient:
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        *,
+        connection: Optional[dict] = None,
+        retry: Optional[dict] = None,
+        rate_limit: Optional[dict] = None,
+        balance_ttl: float = BALANCE_TTL,
+    ):
         self.api_key = api_key
 
         self.loop = asyncio.get_event_loop()
         self.__session = None
-        self.user_agent = (
-            f"RoboBroker Python/{sys.version_info.major}.{sys.version_info.minor} aiohttp/{aiohttp.__version__}"
+
+        connection = connection or {}
+        self.connector_settings = dict(
+            limit=connection.get("limit", CONNECTION_LIMIT),
+            limit_per_host=connection.get("limit_per_host", CONNECTION_LIMIT_PER_HOST),
+            keepalive_timeout=connection.get("keepalive_timeout", KEEPALIVE_TIMEOUT),
+            ttl_dns_cache=connection.get("dns_ttl", DNS_TTL),
+        )
+        self.timeout = aiohttp.ClientTimeout(
+            total=connection.get("request_timeout", REQUEST_TIMEOUT),
+            connect=connection.get("connect_timeout", CONNECT_TIMEOUT),
         )
 
-        self.headers = {
-            "User-Agent": self.user_agent,
-            "Content-Type": "application/json",
-        }
+        self.retry_policy = RetryPolicy(**(retry or {}))
 
-        self.loop.create_task(self.create_sess())
+        # route path -> RouteStats, see `stats`
+        self.routes = {}
 
-    # general tidyness
-    async def create_sess(self):
-        self.__session = aiohttp.ClientSession()
+        # route path -> TokenBucket, created on first use from the route's settings
+        rate_limit = dict(rate_limit or {})
+        self.rate_limit_routes = rate_limit.pop("Routes", {})
+        self.rate_limit_defaults = dict(
+            rate=rate_limit.get("rate", RATE_LIMIT_RATE),
+            burst=rate_limit.get("burst", RATE_LIMIT_BURST),
+            max_wait=rate_limit.get("max_wait", RATE_LIMIT_MAX_WAIT),
+        )
+        self.buckets = {}
+
+        # (currency, api key) -> balance response, dropped by anything that moves money on that key
+        self.balances = TTLCache(balance_ttl)
+        self.user_agent = (
+            f"RoboBroker Python/{sys.version_info.major}.{sys.version_info.minor} aiohttp/{aiohttp.__version__}"
+        )
+
+    # creates the session and its connection pool, must run (once) before the first request
+    async def start(self):
+        if self.__session is None:
+            connector = aiohttp.TCPConnector(use_dns_cache=True, **self.connector_settings)
+            # only the User-Agent by default, payloads are still sent form encoded
+            self.__session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout, headers={"User-Agent": self.user_agent}
+            )
 
     async def close(self):
         if self.__session:
             await self.__session.close()
+            self.__session = None
 
+    # JSON is parsed straight from the body bytes, anything else is returned as text
     @staticmethod
     async def parse_data(response):
-        text = await response.text(encoding="utf-8")
+        body = await response.read()
 
-        if response.headers.get("Content-Type") == "application/json":
-            return json.loads(text)
+        # `content_type` is the bare media type, without `; charset=...`
+        content_type = response.content_type
+        if content_type == "application/json" or content_type.endswith("+json"):
+            return json_loads(body)
 
-        return text
+        return body.decode(response.charset or "utf-8", errors="replace")
 
-    # here's where the magic happens
-    async def request(self, route: Route, data: dict = None, **kwargs):
-        method = route.method
-        url = route.url
+    @classmethod
+    def decode_data(cls, route, data):
+        try:
+            return cls._decode_model(route, data)
 
-        data = data or {}
+        except InvalidResponseError as e:
+            return cls._invalid_response(route, e, data)
+
+    # money has moved once a payment route answers 2xx, so what it sent back is logged and returned as it is
+    # rather than raised like a failure (which invites doing it again); other routes raise `error`
+    @staticmethod
+    def _invalid_response(route, error, data):
+        if not route.moves_money:
+            raise error
+
+        log.error(StructuredMessage("unreadable response to a payment, returning it raw", error=str(error), data=data))
 
-        api_key = self.api_key
+        return data
 
-        if "send_as" in kwargs:
-            api_key = kwargs["send_as"]
+    @staticmethod
+    def _decode_model(route, data):
+        if route.decoder is None:
+            return data
+
+        if not isinstance(data, dict):
+            raise InvalidResponseError(route.path, f"expected a JSON object, got {type(data).__name__}")
 
         try:
-            async with self.__session.request(
-                method, url, params=dict(api_key=api_key), data=data, **kwargs
-            ) as response:
-                log.debug(f"{method} {url} returned {response.status}")
+            return route.decoder.decode(data)
+
+        except KeyError as e:
+            raise InvalidResponseError(route.path, f"missing field {e.args[0]!r}") from None
+
+        except (TypeError, ValueError, decimal.InvalidOperation) as e:
+            raise InvalidResponseError(route.path, f"[{type(e).__name__}]: {e}") from None
+
+    def _bucket(self, route):
+        bucket = self.buckets.get(route.path)
+
+        if bucket is None:
+            settings = {**self.rate_limit_defaults, **self.rate_limit_routes.get(route.path, {})}
+            bucket = self.buckets[route.path] = TokenBucket(route.path, **settings)
+
+        return bucket
+
+    def stats(self):
+        stats = {
+            path: dict(stats.summary(), **self.buckets[path].stats()) if path in self.buckets else stats.summary()
+            for (path, stats) in self.routes.items()
+        }
+        stats["balance cache"] = self.balances.stats()
+
+        return stats
+
+    # one attempt, raises ApiResponseError for anything but a 2xx
+    async def _send(self, route, data, api_key, headers, **kwargs):
+        method = route.method
+        url = route.url
+
+        async with self.__session.request(
+            method, url, params=dict(api_key=api_key), data=data, headers=headers, **kwargs
+        ) as response:
+            log.debug(StructuredMessage("api response", method=method, url=url, status=response.status))
 
+            try:
                 data = await self.parse_data(response)
 
+            except ValueError as e:
+                # labelled JSON but isn't: empty, cut off, or an error page from something in between
+                data = (await response.read()).decode(response.charset or "utf-8", errors="replace")
+
                 if 200 <= response.status < 300:
-                    log.debug(f"^ {method} returned {data}")
+                    error = InvalidResponseError(route.path, f"body is not valid JSON: [{type(e).__name__}]: {e}")
+
+                    return self._invalid_response(route, error, data)
+
+            if 200 <= response.status < 300:
+                log.debug(StructuredMessage("api response data", method=method, data=data))
+
+                return self.decode_data(route, data)
+
+            raise ApiResponseError(response.status, data, parse_retry_after(response.headers.get("Retry-After")))
+
+    # here's where the magic happens
+    # non-idempotent routes are only retried blind if they carry an `idempotency_key` the exchange dedupes on,
+    # otherwise only when the request provably never reached it
+    async def request(self, route: Route, data: dict = None, *, idempotency_key: str = None, **kwargs):
+        data = data or {}
+
+        api_key = kwargs.pop("send_as", self.api_key)
+
+        if self.__session is None:
+            raise RuntimeError("PaymentClient.start() must be awaited before making requests")
+
+        headers = {}
+        if idempotency_key is not None:
+            headers["Idempotency-Key"] = idempotency_key
+
+        repeatable = route.idempotent or idempotency_key is not None
+
+        stats = self.routes.get(route.path)
+        if stats is None:
+            stats = self.routes[route.path] = RouteStats()
+
+        stats.counts["requests"] += 1
+        bucket = self._bucket(route)
 
-                    # TODO: response data validation
+        for attempt in range(1, self.retry_policy.attempts + 1):
+            # queues behind earlier requests on this route, or raises RateLimitExceeded if that would take too long
+            try:
+                await bucket.acquire()
 
-                    return data
+            except RateLimitExceeded:
+                stats.counts["rate_limited"] += 1
+                raise
 
-                else:
-                    log.error(f"^ {method} failed with HTTP {response.status}")
-                    raise ApiResponseError(response.status, data)
+            started = time.perf_counter()
 
-        except Exception as e:
-            print(f"[{type(e).__name__}]: {e}")
+            try:
+                return await self._send(route, data, api_key, headers, **kwargs)
+
+            except Exception as e:
+                # everyone on this route waits out a 429, whether or not this request is retried
+                if isinstance(e, ApiResponseError) and e.status == TOO_MANY_REQUESTS:
+                    bucket.throttle(RETRY_AFTER_DEFAULT if e.retry_after is None else e.retry_after)
+
+                if attempt == self.retry_policy.attempts or not should_retry(e, repeatable):
+                    stats.counts["failed"] += 1
+                    log.error(
+                        StructuredMessage(
+                            "api request failed",
+                            method=route.method,
+                            path=route.path,
+                            attempts=attempt,
+                            error=f"[{type(e).__name__}]: {e}",
+                        )
+                    )
+                    raise
+
+                delay = self.retry_policy.delay(attempt)
+                stats.counts["retries"] += 1
+
+                log.warning(
+                    StructuredMessage(
+                        "retrying api request",
+                        method=route.method,
+                        path=route.path,
+                        attempt=attempt,
+                        delay=round(delay, 3),
+                        error=type(e).__name__,
+                    )
+                )
+
+            finally:
+                stats.latency.observe(time.perf_counter() - started)
+
+            await asyncio.sleep(delay)
 
     # API methods
 
+    # Money-moving calls get an idempotency key, generated here unless the caller brings its own
+    # (pass the same key to retry a call yourself, e.g. after a restart)
+
     # Payment receive
-    def request_payment(self, currency: CurrencyType, amount: float, *, callback_url: str = None, **kwargs):
+    async def request_payment(
+        self,
+        currency: CurrencyType,
+        amount: float,
+        *,
+        callback_url: str = None,
+        idempotency_key: Optional[str] = None,
+        **kwargs,
+    ):
         payload = {"currency": currency.value, "amount": amount}
 
         if callback_url is not None:
             payload["callback"] = callback_url
 
-        return self.request(Route("POST", "payments/receive"), payload, **kwargs)
+        try:
+            return await self.request(
+                Route("POST", "payments/receive", decoder=PAYMENT_REQUEST_DECODER, moves_money=True),
+                payload,
+                idempotency_key=idempotency_key or uuid.uuid4().hex,
+                **kwargs,
+            )
+
+        finally:
+            self.balances.invalidate((currency, kwargs.get("send_as", self.api_key)))
 
     # Payment send
-    def send_payment(
-        self, currency: CurrencyType, address: str, amount: float, *, includes_fee: Optional[bool] = None, **kwargs
+    async def send_payment(
+        self,
+        currency: CurrencyType,
+        address: str,
+        amount: float,
+        *,
+        includes_fee: Optional[bool] = None,
+        idempotency_key: Optional[str] = None,
+        **kwargs,
     ):
         payload = {"currency": currency.value, "amount": amount, "receiveAddress": address}
 
         if includes_fee is not None:
             payload["includeFee"] = includes_fee
 
-        return self.request(Route("POST", "payments/send"), payload, **kwargs)
-
-    # Balance query
-    def check_balance(self, currency: CurrencyType, **kwargs):
+        # even a failed send may have moved money, so the balance is dropped either way
+        try:
+            return await self.request(
+                Route("POST", "payments/send", decoder=SENT_PAYMENT_DECODER, moves_money=True),
+                payload,
+                idempotency_key=idempotency_key or uuid.uuid4().hex,
+                **kwargs,
+            )
+
+        finally:
+            self.balances.invalidate((currency, kwargs.get("send_as", self.api_key)))
+
+    # Balance query, cached for `balance_ttl` and shared between concurrent callers
+    async def check_balance(self, currency: CurrencyType, **kwargs):
         payload = {"currency": currency.value}
 
-        return self.request(Route("POST", "payments/balance"), payload, **kwargs)
+        return await self.balances.get_or_load(
+            (currency, kwargs.get("send_as", self.api_key)),
+            lambda: self.request(
+                Route("POST", "payments/balance", idempotent=True, decoder=BALANCE_DECODER), payload, **kwargs
+            ),
+        )
 
     # Admin-type stuff
 
@@ -0,0 +1,106 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2021 Mieszko Exchange
+
+# An aiomysql pool that knows how long callers wait for it and how old its connections are
+
+__all__ = ("MeasuredPool",)
+
+import asyncio
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+from .metrics import Histogram
+
+
+class MeasuredPool:
+    """Wraps an `aiomysql.Pool`, keeping the same `acquire()` surface while recording acquire waits."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+        self.acquire_wait = Histogram()
+        self.waiting = 0
+
+        # connection -> monotonic time it was first handed out, dropped along with the connection
+        self._born = weakref.WeakKeyDictionary()
+        # connection -> how long its current holder waited for it, until claimed by `take_wait`
+        self._waits = weakref.WeakKeyDictionary()
+
+    @property
+    def minsize(self):
+        return self._pool.minsize
+
+    @property
+    def maxsize(self):
+        return self._pool.maxsize
+
+    @property
+    def size(self):
+        return self._pool.size
+
+    @property
+    def freesize(self):
+        return self._pool.freesize
+
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.perf_counter()
+        self.waiting += 1
+
+        try:
+            conn = await self._pool.acquire()
+
+        finally:
+            self.waiting -= 1
+
+        wait = time.perf_counter() - started
+        self.acquire_wait.observe(wait)
+        self._born.setdefault(conn, time.monotonic())
+        self._waits[conn] = wait
+
+        try:
+            yield conn
+
+        finally:
+            self._waits.pop(conn, None)
+            await self._pool.release(conn)
+
+    # the acquire wait of a connection handed out by this pool, only returned once per acquire
+    def take_wait(self, conn):
+        return self._waits.pop(conn, None)
+
+    # opens (and checks) `minsize` connections up front, so the first commands don't pay for connection setup
+    async def warm_up(self):
+        conns = await asyncio.gather(*(self._pool.acquire() for _ in range(self._pool.minsize)))
+
+        try:
+            for conn in conns:
+                await conn.ping(reconnect=True)
+                self._born.setdefault(conn, time.monotonic())
+
+        finally:
+            for conn in conns:
+                await self._pool.release(conn)
+
+    def stats(self):
+        now = time.monotonic()
+        ages = [now - born for (conn, born) in self._born.items() if not conn.closed]
+
+        return dict(
+            minsize=self.minsize,
+            maxsize=self.maxsize,
+            in_use=self.size - self.freesize,
+            free=self.freesize,
+            waiting=self.waiting,
+            wait=self.acquire_wait.summary(),
+            oldest_conn=max(ages, default=0.0),
+            mean_conn_age=sum(ages) / len(ages) if ages else 0.0,
+        )
+
+    def close(self):
+        self._pool.close()
+
+    async def wait_closed(self):
+        await self._pool.wait_closed()
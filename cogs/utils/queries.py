@@ -0,0 +1,483 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2021 Mieszko Exchange
+
+# Every statement `SQL` issues, normalized and named once at import time
+
+__all__ = ("QueryKind", "Rows", "Query", "QUERIES", "with_filters")
+
+from collections import namedtuple
+from enum import Enum
+from functools import lru_cache
+
+
+# Write statements (locking reads included) always run on the primary, Read ones may go to the replica
+class QueryKind(Enum):
+    Read = "read"
+    Write = "write"
+
+
+# how many rows a statement is expected to return (reads) or touch (writes)
+class Rows(Enum):
+    One = "one"
+    Many = "many"
+
+
+Query = namedtuple("Query", "name sql kind rows")
+
+# name -> Query, for anything that wants to walk every statement (timing, EXPLAIN, preparing)
+QUERIES = {}
+
+
+def _register(name, sql, *, kind, rows):
+    if name in QUERIES:
+        raise ValueError(f"query {name!r} is already registered")
+
+    # collapse to a single line, no statement here relies on whitespace inside literals
+    query = Query(name, " ".join(sql.split()), kind, rows)
+    QUERIES[name] = query
+
+    return query
+
+
+# fills the `{filters}` slot of a registered statement with the named fragments from `fragments`, AND-ed in order
+@lru_cache(maxsize=256)
+def with_filters(query, fragments, names):
+    filters = "".join(f" AND {dict(fragments)[name]}" for name in names)
+
+    return query._replace(sql=query.sql.format(filters=filters))
+
+
+# Currency
+
+CURRENCY_DETAILS = _register(
+    "currency_details",
+    """
+    SELECT * FROM Currency WHERE code = %s;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.One,
+)
+
+ALL_CURRENCIES = _register(
+    "all_currencies",
+    """
+    SELECT id, code, `precision` FROM Currency;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+# User
+
+USER_DETAILS = _register(
+    "user_details",
+    """
+    SELECT * FROM User WHERE discordID = %s;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.One,
+)
+
+CREATE_USER = _register(
+    "create_user",
+    """
+    INSERT INTO `User` (discordID, createdAt, locked)
+    VALUES (%s, %s, %s);
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+# values must stay pure placeholders so executemany can batch this into one multi-row statement
+UPSERT_USER = _register(
+    "upsert_user",
+    """
+    INSERT INTO `User` (discordID, createdAt, locked)
+    VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE discordID = discordID;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.Many,
+)
+
+LOCK_USER = _register(
+    "lock_user",
+    """
+    UPDATE User SET locked = 1 WHERE discordID = %s
+    LIMIT 1;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+UNLOCK_USER = _register(
+    "unlock_user",
+    """
+    UPDATE User SET locked = 0 WHERE discordID = %s
+    LIMIT 1;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+# LinkedAddress
+
+ADDRESS_FOR = _register(
+    "address_for",
+    """
+    SELECT lA.address, lA.public, c.code FROM LinkedAddress lA, Currency c
+    WHERE lA.userID = %s AND lA.currency = c.id AND c.code = %s
+    LIMIT 1;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.One,
+)
+
+ALL_ADDRESSES = _register(
+    "all_addresses",
+    """
+    SELECT lA.address, lA.public, c.code FROM LinkedAddress lA, Currency c
+    WHERE lA.userID = %s and lA.currency = c.id;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+# one currency's addresses for several users at once (LinkedAddress holds at most one per user and currency)
+ADDRESSES_FOR_USERS = _register(
+    "addresses_for_users",
+    """
+    SELECT lA.userID, lA.address, lA.public, c.code FROM LinkedAddress lA, Currency c
+    WHERE lA.userID IN %s AND lA.currency = c.id AND c.code = %s;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+# reverse lookup, the parameters are `MD5(address)` digests (hashes can collide, so check `address` on read)
+ADDRESS_OWNERS = _register(
+    "address_owners",
+    """
+    SELECT lA.userID, lA.address, lA.public, c.code FROM LinkedAddress lA, Currency c
+    WHERE lA.addressHash IN %s AND lA.currency = c.id;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+SET_ADDRESS_PRIVATE = _register(
+    "set_address_private",
+    """
+    UPDATE LinkedAddress SET public = 0
+    WHERE userID = %s AND address = %s;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+SET_ADDRESS_PUBLIC = _register(
+    "set_address_public",
+    """
+    UPDATE LinkedAddress SET public = 1
+    WHERE userID = %s AND address = %s;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+ADD_ADDRESS = _register(
+    "add_address",
+    """
+    INSERT INTO LinkedAddress (userID, currency, address, public)
+    VALUES (%s, (SELECT id from Currency WHERE code = %s LIMIT 1), %s, %s);
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+DELETE_ADDRESS = _register(
+    "delete_address",
+    """
+    DELETE FROM LinkedAddress
+    WHERE userID = %s AND address = %s
+    LIMIT 1;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+# EscrowPayment
+
+# optional filters for the PAYMENTS_* statements below, keyed by parameter name (see `with_filters`)
+PAYMENT_FILTERS = (
+    ("sender_id", "E.sender = %(sender_id)s"),
+    ("receiver_id", "E.receiver = %(receiver_id)s"),
+    ("currency_id", "E.currency = %(currency_id)s"),
+    ("statuses", "E.status IN %(statuses)s"),
+    ("since", "E.startedAt >= %(since)s"),
+    ("until", "E.startedAt < %(until)s"),
+    # keyset pagination: ids only grow, so "older than the last row seen" is just a smaller id
+    ("before_id", "E.id < %(before_id)s"),
+    # the same for the *_BY_DATE statements, which are ordered by (startedAt, id); spelled out as an OR rather than
+    # a row comparison so MariaDB turns it into ranges on the `started` key too
+    (
+        "before_started",
+        "(E.startedAt < %(before_started)s OR (E.startedAt = %(before_started)s AND E.id < %(before_id)s))",
+    ),
+)
+
+PAYMENTS_PAGE = _register(
+    "payments_page",
+    """
+    SELECT E.*, C.code FROM EscrowPayment E, Currency C
+    WHERE C.id = E.currency{filters}
+    ORDER BY E.id DESC
+    LIMIT %(limit)s;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+# same as PAYMENTS_PAGE without the LIMIT, meant for an unbuffered cursor
+PAYMENTS_SCAN = _register(
+    "payments_scan",
+    """
+    SELECT E.*, C.code FROM EscrowPayment E, Currency C
+    WHERE C.id = E.currency{filters}
+    ORDER BY E.id DESC;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+# for date-filtered listings: ordered by the `started (startedAt, id)` key, so it serves both the range and the order
+PAYMENTS_PAGE_BY_DATE = _register(
+    "payments_page_by_date",
+    """
+    SELECT E.*, C.code FROM EscrowPayment E, Currency C
+    WHERE C.id = E.currency{filters}
+    ORDER BY E.startedAt DESC, E.id DESC
+    LIMIT %(limit)s;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+PAYMENTS_SCAN_BY_DATE = _register(
+    "payments_scan_by_date",
+    """
+    SELECT E.*, C.code FROM EscrowPayment E, Currency C
+    WHERE C.id = E.currency{filters}
+    ORDER BY E.startedAt DESC, E.id DESC;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+# EscrowPaymentArchive has the same columns in the same order, so these decode like the ones above
+
+ARCHIVED_PAYMENTS_PAGE = _register(
+    "archived_payments_page",
+    """
+    SELECT E.*, C.code FROM EscrowPaymentArchive E, Currency C
+    WHERE C.id = E.currency{filters}
+    ORDER BY E.id DESC
+    LIMIT %(limit)s;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+ARCHIVED_PAYMENTS_SCAN = _register(
+    "archived_payments_scan",
+    """
+    SELECT E.*, C.code FROM EscrowPaymentArchive E, Currency C
+    WHERE C.id = E.currency{filters}
+    ORDER BY E.id DESC;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+ARCHIVED_PAYMENTS_PAGE_BY_DATE = _register(
+    "archived_payments_page_by_date",
+    """
+    SELECT E.*, C.code FROM EscrowPaymentArchive E, Currency C
+    WHERE C.id = E.currency{filters}
+    ORDER BY E.startedAt DESC, E.id DESC
+    LIMIT %(limit)s;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+ARCHIVED_PAYMENTS_SCAN_BY_DATE = _register(
+    "archived_payments_scan_by_date",
+    """
+    SELECT E.*, C.code FROM EscrowPaymentArchive E, Currency C
+    WHERE C.id = E.currency{filters}
+    ORDER BY E.startedAt DESC, E.id DESC;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+CREATE_PAYMENT = _register(
+    "create_payment",
+    """
+    INSERT INTO EscrowPayment (currency, sender, receiver, sourceAddress, destAddress, status, amount, startedAt, forMessage)
+    VALUES ((SELECT id FROM Currency WHERE code = %s), %s, %s, %s, %s, 'pending', %s, %s, %s)
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+PAYMENT_BY_ID = _register(
+    "payment_by_id",
+    """
+    SELECT E.*, C.code FROM EscrowPayment E, Currency C
+    WHERE E.id = %s AND C.id = E.currency;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.One,
+)
+
+ACTIVE_PAYMENT_BY_PARTICIPANTS = _register(
+    "active_payment_by_participants",
+    """
+    SELECT E.*, C.code FROM EscrowPayment E, Currency C
+    WHERE E.sender = %s AND E.receiver = %s AND E.active = 1
+    AND C.id = E.currency;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.One,
+)
+
+UPDATE_PAYMENT_STATUS = _register(
+    "update_payment_status",
+    """
+    UPDATE EscrowPayment SET status = %s, lastActionAt = %s
+    WHERE id = %s;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+# compare-and-set: only lands if the payment is still in one of the expected statuses
+UPDATE_PAYMENT_STATUS_IF = _register(
+    "update_payment_status_if",
+    """
+    UPDATE EscrowPayment SET status = %s, lastActionAt = %s
+    WHERE id = %s AND status IN %s;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+# LAST_INSERT_ID(id) hands back the id of the changed row, so no SELECT is needed to find it
+UPDATE_ACTIVE_PAYMENT_STATUS_IF = _register(
+    "update_active_payment_status_if",
+    """
+    UPDATE EscrowPayment SET status = %s, lastActionAt = %s, id = LAST_INSERT_ID(id)
+    WHERE sender = %s AND receiver = %s AND active = 1 AND status IN %s;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+# Archival, one batch per transaction: lock, copy, delete
+
+# finished payments only ever change by being archived, the lock keeps a concurrent archiver off the same rows
+ARCHIVABLE_PAYMENTS = _register(
+    "archivable_payments",
+    """
+    SELECT id FROM EscrowPayment
+    WHERE active IS NULL AND lastActionAt < %s
+    LIMIT %s
+    FOR UPDATE;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.Many,
+)
+
+# columns are spelled out, `active` is generated in EscrowPayment and can't be copied
+ARCHIVE_PAYMENTS = _register(
+    "archive_payments",
+    """
+    INSERT INTO EscrowPaymentArchive
+    (id, currency, sender, receiver, sourceAddress, destAddress, status, amount, startedAt, forMessage, lastActionAt)
+    SELECT id, currency, sender, receiver, sourceAddress, destAddress, status, amount, startedAt, forMessage, lastActionAt
+    FROM EscrowPayment WHERE id IN %s;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.Many,
+)
+
+DELETE_ARCHIVED_PAYMENTS = _register(
+    "delete_archived_payments",
+    """
+    DELETE FROM EscrowPayment WHERE id IN %s;
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.Many,
+)
+
+# EscrowEvent
+
+# the latest event of a payment, `id` breaks ties between events in the same second
+PAYMENT_EVENT = _register(
+    "payment_event",
+    """
+    SELECT id, paymentID, action, actioner, actionerID, actionAt, actionMsg FROM EscrowEvent
+    WHERE paymentID = %s
+    ORDER BY actionAt DESC, id DESC
+    LIMIT 1;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.One,
+)
+
+PAYMENT_HISTORY = _register(
+    "payment_history",
+    """
+    SELECT id, paymentID, action, actioner, actionerID, actionAt, actionMsg FROM EscrowEvent
+    WHERE paymentID = %s
+    ORDER BY actionAt, id;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+PAYMENT_HISTORIES = _register(
+    "payment_histories",
+    """
+    SELECT id, paymentID, action, actioner, actionerID, actionAt, actionMsg FROM EscrowEvent
+    WHERE paymentID IN %s
+    ORDER BY paymentID, actionAt, id;
+    """,
+    kind=QueryKind.Read,
+    rows=Rows.Many,
+)
+
+CREATE_PAYMENT_EVENT = _register(
+    "create_payment_event",
+    """
+    INSERT INTO EscrowEvent (paymentID, action, actioner, actionerID, actionAt, actionMsg)
+    VALUES (%s, %s, %s, %s, %s, %s);
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
+
+# LoggedError
+
+CREATE_ERROR_REPORT = _register(
+    "create_error_report",
+    """
+    INSERT INTO LoggedError (`level`, module, function, filename, lineno, message, `timestamp`)
+    VALUES (%s, %s, %s, %s, %s, %s, %s);
+    """,
+    kind=QueryKind.Write,
+    rows=Rows.One,
+)
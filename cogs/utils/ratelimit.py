@@ -0,0 +1,108 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2021 Mieszko Exchange
+
+# Client-side rate limiting, so bursts queue up here instead of being turned away by the other side
+
+__all__ = ("RateLimitExceeded", "TokenBucket")
+
+import asyncio
+
+from .metrics import Histogram
+
+
+class RateLimitExceeded(Exception):
+    """Raised instead of queueing when a request would have to wait longer than the bucket allows."""
+
+    def __init__(self, name, wait):
+        self.name = name
+        self.wait = wait
+
+    def __str__(self):
+        return f"{self.name} is rate limited, next slot in ~{self.wait:.1f}s"
+
+
+class TokenBucket:
+    """`rate` requests per second on average, up to `burst` at once.
+
+    Waiters are served strictly first come, first served. A caller that would wait more than `max_wait` gets
+    `RateLimitExceeded` straight away rather than joining the queue.
+    """
+
+    def __init__(self, name, *, rate, burst, max_wait):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+        self.loop = asyncio.get_event_loop()
+
+        self.tokens = float(burst)
+        self.updated = self.loop.time()
+        # nothing goes out before this (loop time), set by the other side telling us to back off
+        self.blocked_until = 0.0
+
+        # asyncio.Lock wakes waiters in order, holding it while sleeping is what makes the queue fair
+        self._lock = asyncio.Lock()
+
+        self.waiting = 0
+        self.wait = Histogram()
+        self.rejected = 0
+        self.throttled = 0
+
+    def _refill(self, now):
+        # `updated` is in the future while throttled, nothing refills until then
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    # how long a new caller would wait, with everyone already queued going first
+    def estimated_wait(self):
+        now = self.loop.time()
+        self._refill(now)
+
+        backlog = max(0.0, self.waiting + 1 - self.tokens)
+
+        return max(0.0, self.blocked_until - now) + backlog / self.rate
+
+    async def acquire(self):
+        estimate = self.estimated_wait()
+
+        if estimate > self.max_wait:
+            self.rejected += 1
+            raise RateLimitExceeded(self.name, estimate)
+
+        started = self.loop.time()
+        self.waiting += 1
+
+        try:
+            async with self._lock:
+                while True:
+                    now = self.loop.time()
+                    self._refill(now)
+
+                    if now >= self.blocked_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+
+                    await asyncio.sleep(max(self.blocked_until - now, (1 - self.tokens) / self.rate))
+
+        finally:
+            self.waiting -= 1
+
+        self.wait.observe(self.loop.time() - started)
+
+    # the other side said "too many requests": stop for `retry_after` seconds and start over with an empty bucket
+    def throttle(self, retry_after):
+        self.throttled += 1
+        self.blocked_until = max(self.blocked_until, self.loop.time() + retry_after)
+        self.tokens = 0.0
+        self.updated = self.blocked_until
+
+    def stats(self):
+        return dict(
+            queued=self.waiting,
+            rejected=self.rejected,
+            throttled=self.throttled,
+            **{f"wait_{key}": value for (key, value) in self.wait.summary().items()},
+        )
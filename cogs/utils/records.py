@@ -0,0 +1,107 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2021 Mieszko Exchange
+
+# Compact record types and a decoder that turns whole result sets into them
+
+__all__ = ("Record", "RowDecoder", "lookup_table")
+
+from datetime import datetime
+
+
+# compiles `source` (one function definition) with `namespace` as its globals and returns the function
+def _compile(source, name, namespace):
+    exec(source, namespace)
+
+    return namespace[name]
+
+
+class Record:
+    """Base for `__slots__` records, a namedtuple-compatible surface without the per-instance tuple.
+
+    Every subclass gets an `__init__` generated for its fields, like dataclasses do, so building one costs
+    plain attribute stores rather than a loop over `__slots__`.
+    """
+
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        fields = cls.__dict__.get("__slots__", ())
+        body = "".join(f"    self.{name} = {name}\n" for name in fields) or "    pass\n"
+
+        cls.__init__ = _compile(f"def __init__(self, {', '.join(fields)}):\n{body}", "__init__", {})
+        cls.__init__.__qualname__ = f"{cls.__qualname__}.__init__"
+
+    @property
+    def _fields(self):
+        return self.__slots__
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def _replace(self, **kwargs):
+        return type(self)(**{**self._asdict(), **kwargs})
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+
+        return self._values() == other._values()
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+
+# value -> member, a plain dict lookup is much cheaper than calling the Enum per row
+def lookup_table(enum):
+    return {member.value: member for member in enum}.__getitem__
+
+
+def _datetime_or_none(value):
+    # zero dates come back from the driver as strings
+    return value if isinstance(value, datetime) else None
+
+
+class RowDecoder:
+    """Maps result columns onto a `Record` type by position, converting a whole result set in one pass.
+
+    Each field is given as a column index, or as `(index, converter)`. Any subscript works as the index, so a
+    mapping (e.g. a decoded JSON object) can be read by key the same way.
+    """
+
+    datetime_or_none = staticmethod(_datetime_or_none)
+
+    def __init__(self, model, **columns):
+        missing = set(model.__slots__) - set(columns)
+
+        if missing:
+            raise TypeError(f"no column given for {', '.join(sorted(missing))} of {model.__name__}")
+
+        self.model = model
+
+        # one straight-line expression per field, e.g. `row[0]` or `convert_1(row[12])`, compiled into `decode`
+        namespace = {"model": model}
+        arguments = []
+        for (position, name) in enumerate(model.__slots__):
+            column = columns[name]
+            (index, convert) = column if isinstance(column, tuple) else (column, None)
+
+            if convert is None:
+                arguments.append(f"row[{index!r}]")
+
+            else:
+                namespace[f"convert_{position}"] = convert
+                arguments.append(f"convert_{position}(row[{index!r}])")
+
+        self.decode = _compile(f"def decode(row):\n    return model({', '.join(arguments)})\n", "decode", namespace)
+
+    def decode_all(self, rows):
+        return list(map(self.decode, rows))
@@ -8,7 +8,6 @@ CREATE TABLE Currency (
   code varchar(4) NOT NULL UNIQUE KEY,
   `precision` tinyint(3) unsigned NOT NULL,
   PRIMARY KEY (id)
-  KEY (code),
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 -- Database error logging
@@ -38,8 +37,10 @@ CREATE TABLE LinkedAddress (
     currency int(10) unsigned NOT NULL,
     address varchar(256) NOT NULL,
     public tinyint(1) unsigned NOT NULL DEFAULT 1,
+    -- fixed-width stand-in for `address` in the reverse lookup index, checked against `address` on read
+    addressHash binary(16) AS (UNHEX(MD5(address))) STORED,
     PRIMARY KEY (userID, currency),
-    KEY (address),
+    KEY addressHash (addressHash),
     FOREIGN KEY (userID) REFERENCES User (discordID) ON UPDATE CASCADE,
     FOREIGN KEY (currency) REFERENCES Currency (id) ON UPDATE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -57,8 +58,15 @@ CREATE TABLE EscrowPayment (
     startedAt timestamp NOT NULL,
     forMessage tinytext,
     lastActionAt timestamp,
+    -- 1 while the payment can still change, NULL once it's finished. NULLs never collide in a UNIQUE key,
+    -- so activePair allows at most one active payment per sender/receiver pair and serves active lookups directly
+    active tinyint(1) unsigned AS (IF(status IN ('pending', 'paid'), 1, NULL)) STORED,
     PRIMARY KEY (id),
-    KEY(sender, receiver),
+    UNIQUE KEY activePair (sender, receiver, active),
+    -- finished payments by age, for the archival job
+    KEY finished (active, lastActionAt),
+    -- payment listings filtered by start date (`since` / `until`), newest first
+    KEY started (startedAt, id),
     KEY (sourceAddress, destAddress),
     KEY (currency),
     KEY (sender),
@@ -68,17 +76,45 @@ CREATE TABLE EscrowPayment (
     FOREIGN KEY (receiver) REFERENCES User (discordID) ON UPDATE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
--- Escrow action details
+-- Finished payments moved out of EscrowPayment once they're old enough (see `SQL.archive_payments`), so the hot
+-- table only grows with activity. Same columns in the same order, so both decode the same way.
+CREATE TABLE EscrowPaymentArchive (
+    id bigint unsigned NOT NULL,
+    currency int(10) unsigned NOT NULL,
+    sender bigint unsigned NOT NULL,
+    receiver bigint unsigned NOT NULL,
+    sourceAddress varchar(256) NOT NULL,
+    destAddress varchar(256) NOT NULL,
+    status enum('pending', 'paid', 'complete', 'failed') NOT NULL,
+    amount decimal(24, 12) unsigned NOT NULL,
+    startedAt timestamp NOT NULL,
+    forMessage tinytext,
+    lastActionAt timestamp,
+    active tinyint(1) unsigned DEFAULT NULL, -- always NULL here
+    PRIMARY KEY (id),
+    KEY started (startedAt, id),
+    KEY (sourceAddress, destAddress),
+    KEY (currency),
+    KEY (sender),
+    KEY (receiver),
+    FOREIGN KEY (currency) REFERENCES Currency (id) ON UPDATE CASCADE,
+    FOREIGN KEY (sender) REFERENCES User (discordID) ON UPDATE CASCADE,
+    FOREIGN KEY (receiver) REFERENCES User (discordID) ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Escrow action details, append-only: a payment gets one row per action taken on it
+-- paymentID has no foreign key, the payment lives in EscrowPayment or EscrowPaymentArchive
 CREATE TABLE EscrowEvent (
-    paymentID serial,
+    id serial,
+    paymentID bigint unsigned NOT NULL,
     action enum('cancel', 'release', 'abort'),
     actioner enum('sender', 'receiver', 'moderator') NOT NULL,
     actionerID bigint unsigned NOT NULL,
     actionAt timestamp NOT NULL,
     actionMsg tinytext,
-    PRIMARY KEY (paymentID),
+    PRIMARY KEY (id),
+    KEY paymentTimeline (paymentID, actionAt),
     KEY (actioner),
     KEY (actionerID),
-    FOREIGN KEY (paymentID) REFERENCES EscrowPayment (id) ON UPDATE CASCADE ON DELETE CASCADE,
     FOREIGN KEY (actionerID) REFERENCES User (discordID) ON UPDATE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,396 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2021 Mieszko Exchange
+
+# Query-plan regression check
+#
+# Loads cogs/utils/schema.sql into a scratch database, seeds it with a large synthetic dataset, then runs EXPLAIN on
+# every statement registered in cogs/utils/queries.py. Exits non-zero if a statement has no sample parameters here,
+# fails to EXPLAIN, does a full table scan or needs a filesort (unless it's listed as allowed below).
+#
+#   python explain_queries.py [--database medb_plans] [--payments 200000] [--keep]
+#
+# Connection details default to the [Database] section of credentials.toml (if there is one). The scratch database is created by this
+# script and refused if it already exists, so it never touches real data.
+
+import argparse
+import asyncio
+import hashlib
+import sys
+from datetime import datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+
+import aiomysql
+
+from cogs.utils import config
+from cogs.utils import queries as Q
+
+SCHEMA_PATH = Path(__file__).parent / "cogs" / "utils" / "schema.sql"
+
+# tables (and the aliases queries give them) small enough that a full scan is the right plan
+SMALL_TABLES = {"Currency", "C", "c"}
+
+# statements (or filter variants, as "name[filters]") that scan by design, with why
+ALLOWED_SCANS = {
+    "all_currencies": "loads the whole (tiny) Currency table at init",
+    **{
+        f"{table}_scan{variant}": reason
+        for table in ("payments", "archived_payments")
+        for (variant, reason) in (
+            ("[]", "unfiltered streaming export walks the whole table"),
+            ("[statuses]", "status isn't indexed, an export by status reads every row anyway"),
+            ("[currency_id]", "there are only a few currencies, an export of one reads a large share of the table"),
+        )
+    },
+    **{
+        f"{table}_scan_by_date[until]": "everything started before a date is most of the table, scanning is cheaper"
+        for table in ("payments", "archived_payments")
+    },
+    **{
+        f"{table}_{kind}_by_date[{user}, since]": "a single user's payments, few enough to sort"
+        for table in ("payments", "archived_payments")
+        for kind in ("page", "scan")
+        for user in ("sender_id", "receiver_id")
+    },
+}
+
+# filter combinations to check for statements with a `{filters}` slot (see `queries.with_filters`), the id-ordered
+# statements never get a date filter (`SQL.get_payments` switches to the *_by_date ones for that)
+FILTER_VARIANTS = (
+    (),
+    ("sender_id",),
+    ("receiver_id",),
+    ("currency_id",),
+    ("before_id",),
+    ("sender_id", "before_id"),
+    ("receiver_id", "before_id"),
+    ("sender_id", "statuses"),
+    ("statuses",),
+)
+
+# the same for the *_by_date statements, which are only used with `since` and/or `until`
+DATE_FILTER_VARIANTS = (
+    ("since",),
+    ("until",),
+    ("since", "until"),
+    ("since", "before_started"),
+    ("since", "until", "before_started"),
+    ("statuses", "since"),
+    ("sender_id", "since"),
+    ("receiver_id", "since"),
+)
+
+BASE_USER_ID = 100_000_000_000_000_000
+BATCH_SIZE = 5000
+
+CURRENCIES = (("TNBC", 4), ("LTC", 8), ("BTC", 8))
+
+
+class Dataset:
+    def __init__(self, payments):
+        self.payments = payments
+        self.users = max(1000, payments // 20)
+        # every pair gets ~10 payments of history, only the newest can still be active
+        self.pairs = max(1, payments // 10)
+        self.started = datetime(2021, 1, 1)
+
+    def user_id(self, index):
+        return BASE_USER_ID + index
+
+    def pair(self, pair_index):
+        sender = pair_index % self.users
+        receiver = (sender + 1 + pair_index // self.users) % self.users
+
+        return (self.user_id(sender), self.user_id(receiver))
+
+    # the pair of the last payment written, which is active
+    @property
+    def active_pair(self):
+        return self.pair(0)
+
+
+async def load_schema(cur):
+    lines = [line for line in SCHEMA_PATH.read_text().splitlines() if not line.lstrip().startswith("--")]
+
+    for statement in "\n".join(lines).split(";"):
+        if statement.strip():
+            await cur.execute(statement)
+
+
+async def insert_batched(cur, sql, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        await cur.executemany(sql, rows[start : start + BATCH_SIZE])
+
+
+async def seed(cur, data):
+    await cur.executemany("INSERT INTO Currency (code, `precision`) VALUES (%s, %s);", CURRENCIES)
+
+    await insert_batched(
+        cur,
+        "INSERT INTO `User` (discordID, createdAt, locked) VALUES (%s, %s, %s);",
+        [(data.user_id(index), data.started, 0) for index in range(data.users)],
+    )
+
+    await insert_batched(
+        cur,
+        "INSERT INTO LinkedAddress (userID, currency, address, public) VALUES (%s, %s, %s, %s);",
+        [
+            (data.user_id(index), currency_id, f"addr-{currency_id}-{index:040d}", index % 2)
+            for index in range(data.users)
+            for currency_id in (2, 3)
+        ],
+    )
+
+    payments = []
+    events = []
+    for index in range(data.payments):
+        pair_index = index % data.pairs
+        (sender, receiver) = data.pair(pair_index)
+        started_at = data.started + timedelta(seconds=index)
+
+        # the newest payment of every fourth pair is still active, everything else is finished
+        if index >= data.payments - data.pairs and pair_index % 4 == 0:
+            status = "pending" if pair_index % 8 == 0 else "paid"
+
+        else:
+            status = "complete" if index % 3 else "failed"
+            events.append((index + 1, "release" if status == "complete" else "cancel", "sender", sender, started_at))
+
+        payments.append(
+            (
+                1 + index % len(CURRENCIES),
+                sender,
+                receiver,
+                f"src-{sender}",
+                f"dst-{receiver}",
+                status,
+                Decimal("0.5"),
+                started_at,
+                None,
+                started_at,
+            )
+        )
+
+    await insert_batched(
+        cur,
+        "INSERT INTO EscrowPayment (currency, sender, receiver, sourceAddress, destAddress, status, amount, startedAt, forMessage, lastActionAt) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);",
+        payments,
+    )
+
+    await insert_batched(
+        cur,
+        "INSERT INTO EscrowEvent (paymentID, action, actioner, actionerID, actionAt) VALUES (%s, %s, %s, %s, %s);",
+        events,
+    )
+
+    # a copy (not a move) of the older half of the finished payments, so the archive is just as big to plan against
+    await cur.execute(
+        "INSERT INTO EscrowPaymentArchive (id, currency, sender, receiver, sourceAddress, destAddress, status, amount, startedAt, forMessage, lastActionAt) SELECT id, currency, sender, receiver, sourceAddress, destAddress, status, amount, startedAt, forMessage, lastActionAt FROM EscrowPayment WHERE active IS NULL AND id <= %s;",
+        (data.payments // 2,),
+    )
+
+    for table in ("Currency", "User", "LinkedAddress", "EscrowPayment", "EscrowPaymentArchive", "EscrowEvent"):
+        await cur.execute(f"ANALYZE TABLE {table};")
+        await cur.fetchall()
+
+
+# sample parameters for every registered statement, keyed by name
+def sample_values(data):
+    (sender, receiver) = data.active_pair
+    now = datetime.utcnow()
+    address = "addr-3-" + "0" * 40
+    new_user = data.user_id(data.users + 1)
+    payment_id = data.payments // 2
+
+    payment_filters = {
+        "sender_id": sender,
+        "receiver_id": receiver,
+        "currency_id": 3,
+        "statuses": ("pending", "paid"),
+        # a narrow window among the newest payments, so an index on startedAt is worth using
+        "since": data.started + timedelta(seconds=data.payments - 1000),
+        "until": data.started + timedelta(seconds=data.payments - 500),
+        "before_id": payment_id,
+        "before_started": data.started + timedelta(seconds=data.payments - 750),
+    }
+
+    return {
+        "currency_details": ("BTC",),
+        "all_currencies": None,
+        "user_details": (sender,),
+        "create_user": (new_user, now, 0),
+        "upsert_user": (sender, now, 0),
+        "lock_user": (sender,),
+        "unlock_user": (sender,),
+        "address_for": (sender, "BTC"),
+        "all_addresses": (sender,),
+        "addresses_for_users": ((sender, receiver), "BTC"),
+        "address_owners": ((hashlib.md5(address.encode()).digest(),),),
+        "set_address_private": (sender, address),
+        "set_address_public": (sender, address),
+        "add_address": (new_user, "BTC", address, 0),
+        "delete_address": (sender, address),
+        "payments_page": {**payment_filters, "limit": 50},
+        "payments_scan": payment_filters,
+        "archived_payments_page": {**payment_filters, "limit": 50},
+        "archived_payments_scan": payment_filters,
+        "payments_page_by_date": {**payment_filters, "limit": 50},
+        "payments_scan_by_date": payment_filters,
+        "archived_payments_page_by_date": {**payment_filters, "limit": 50},
+        "archived_payments_scan_by_date": payment_filters,
+        "create_payment": ("BTC", sender, receiver, "src", "dst", Decimal("1"), now, None),
+        "payment_by_id": (payment_id,),
+        "active_payment_by_participants": (sender, receiver),
+        "update_payment_status": ("failed", now, payment_id),
+        "update_payment_status_if": ("failed", now, payment_id, ("pending", "paid")),
+        "update_active_payment_status_if": ("failed", now, sender, receiver, ("pending", "paid")),
+        "archivable_payments": (data.started + timedelta(seconds=payment_id), 500),
+        "archive_payments": ((payment_id, payment_id + 1),),
+        "delete_archived_payments": ((payment_id, payment_id + 1),),
+        "payment_event": (payment_id,),
+        "payment_history": (payment_id,),
+        "payment_histories": ((payment_id, payment_id + 1, payment_id + 2),),
+        "create_payment_event": (payment_id, "release", "sender", sender, now, None),
+        "create_error_report": ("ERROR", "module", "function", "file.py", 1, "message", now),
+    }
+
+
+def find_problems(label, plan):
+    if label in ALLOWED_SCANS:
+        return []
+
+    problems = []
+    for row in plan:
+        # the INSERT side of INSERT ... SELECT shows up as a scan of the target table, nothing is read from it
+        if row.get("select_type") == "INSERT" or row.get("rows") is None:
+            continue
+
+        table = row.get("table")
+        extra = row.get("Extra") or ""
+
+        if row.get("type") == "ALL" and table not in SMALL_TABLES:
+            problems.append(f"full table scan on {table} ({row.get('rows')} rows)")
+
+        if "filesort" in extra:
+            problems.append(f"filesort on {table} ({extra})")
+
+    return problems
+
+
+async def explain(cur, sql, values):
+    await cur.execute(f"EXPLAIN {sql}", values)
+
+    return await cur.fetchall()
+
+
+async def check_plans(cur, data):
+    samples = sample_values(data)
+    failures = {}
+
+    for (name, query) in Q.QUERIES.items():
+        if name not in samples:
+            failures[name] = ["no sample parameters in explain_queries.py"]
+            continue
+
+        values = samples[name]
+
+        if "{filters}" in query.sql:
+            variants = []
+            for names in DATE_FILTER_VARIANTS if name.endswith("_by_date") else FILTER_VARIANTS:
+                label = f"{name}[{', '.join(names)}]"
+                filtered = Q.with_filters(query, Q.PAYMENT_FILTERS, names)
+                variants.append((label, filtered.sql))
+
+        else:
+            variants = [(name, query.sql)]
+
+        for (label, sql) in variants:
+            try:
+                plan = await explain(cur, sql, values)
+
+            except Exception as e:
+                failures[label] = [f"EXPLAIN failed: [{type(e).__name__}]: {e}"]
+                continue
+
+            problems = find_problems(label, plan)
+            status = "FAIL" if problems else "ok"
+            keys = ", ".join(f"{row.get('table')}:{row.get('type')}/{row.get('key')}" for row in plan)
+            print(f"[{status:>4}] {label}: {keys}")
+
+            if problems:
+                failures[label] = problems
+
+    for name in set(samples) - set(Q.QUERIES):
+        print(f"[warn] sample parameters for unknown statement {name!r}")
+
+    return failures
+
+
+async def main(args):
+    try:
+        credentials = config.read("./credentials.toml")["Database"]
+
+    except config.ConfigReadError:
+        # CI passes everything on the command line
+        credentials = {}
+
+    conn = await aiomysql.connect(
+        host=args.host or credentials["host"],
+        port=args.port or credentials.get("port", 3306),
+        user=args.user or credentials["user"],
+        password=args.password if args.password is not None else credentials["password"],
+        charset="utf8mb4",
+        autocommit=True,
+    )
+
+    try:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute("SHOW DATABASES LIKE %s;", (args.database,))
+
+            if await cur.fetchall():
+                print(f"database {args.database!r} already exists, refusing to use it", file=sys.stderr)
+                return 2
+
+            await cur.execute(f"CREATE DATABASE `{args.database}` DEFAULT CHARSET utf8mb4;")
+
+            try:
+                await conn.select_db(args.database)
+                await load_schema(cur)
+
+                data = Dataset(args.payments)
+                print(f"Seeding {data.users} users, {data.payments} payments over {data.pairs} pairs..")
+                await seed(cur, data)
+
+                failures = await check_plans(cur, data)
+
+            finally:
+                if not args.keep:
+                    await cur.execute(f"DROP DATABASE `{args.database}`;")
+
+    finally:
+        conn.close()
+
+    if failures:
+        print(f"\n{len(failures)} statement(s) failed:")
+        for (label, problems) in failures.items():
+            for problem in problems:
+                print(f"  {label}: {problem}")
+
+        return 1
+
+    print("\nAll query plans ok")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXPLAIN every registered SQL statement against a seeded database")
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--user")
+    parser.add_argument("--password")
+    parser.add_argument("--database", default="medb_plans", help="scratch database to create (must not exist)")
+    parser.add_argument("--payments", type=int, default=200_000, help="synthetic EscrowPayment rows to seed")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch database afterwards")
+
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -4,7 +4,7 @@
 
 import asyncio
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import aiohttp
@@ -14,7 +14,7 @@ from discord.ext import commands, ipc
 from cogs.utils import colors as C
 from cogs.utils import config, logger
 from cogs.utils.db import SQL
-from cogs.utils.payment_api import PaymentClient
+from cogs.utils.payment_api import BALANCE_TTL, PaymentClient
 
 # Attempt to load uvloop for improved event loop performance
 try:
@@ -40,6 +40,10 @@ class Builtin(commands.Cog):
     @commands.is_owner()
     async def quit_command(self, ctx):
         await self.bot.payment_client.close()
+
+        if logger.DATABASE_HANDLER is not None:
+            await logger.DATABASE_HANDLER.stop()
+
         await self.bot.db.close()
 
         await self.bot.logout()
@@ -121,6 +125,93 @@ class Builtin(commands.Cog):
             else:
                 await self.bot.post_reaction(ctx.message, success=True)
 
+    @commands.group(name="db", brief="manage the database", invoke_without_command=True)
+    @commands.is_owner()
+    async def manage_db(self, ctx):
+        await self.bot.post_reaction(ctx.message, emoji="\N{CALL ME HAND}")
+
+    @manage_db.command(name="backfill", brief="create users for every member")
+    @commands.is_owner()
+    async def backfill_users(self, ctx):
+        user_ids = {member.id for member in self.bot.get_all_members() if not member.bot}
+        started = datetime.utcnow()
+
+        async with ctx.typing():
+            created = await self.bot.db.ensure_users(user_ids)
+
+        await ctx.send(f"Checked {len(user_ids)} members, created {created} new users in {datetime.utcnow() - started}")
+
+    @manage_db.command(name="archive", brief="archive finished payments now")
+    @commands.is_owner()
+    async def archive_payments(self, ctx, days: int = None):
+        older_than = None if days is None else timedelta(days=days)
+        started = datetime.utcnow()
+
+        async with ctx.typing():
+            moved = await self.bot.db.archive_payments(older_than=older_than)
+
+        await ctx.send(
+            f"Archived {moved} finished payments in {datetime.utcnow() - started} ({self.bot.db.archived} since startup)"
+        )
+
+    @manage_db.command(name="routing", brief="show read replica routing stats")
+    @commands.is_owner()
+    async def routing_stats(self, ctx):
+        stats = self.bot.db.routing_stats()
+        await ctx.send(f"```\n{' '.join(f'{key}={value}' for (key, value) in stats.items())}\n```")
+
+    @manage_db.command(name="pool", brief="show connection pool stats")
+    @commands.is_owner()
+    async def pool_stats(self, ctx):
+        lines = []
+        for (name, stats) in self.bot.db.pool_stats().items():
+            wait = stats.pop("wait")
+            lines.append(f"{name}: {' '.join(f'{key}={value:.4g}' for (key, value) in stats.items())}")
+            lines.append(f"  acquire wait (s): {' '.join(f'{key}={value:.4g}' for (key, value) in wait.items())}")
+
+        await ctx.send("```\n{}\n```".format("\n".join(lines) or "Database not ready"))
+
+    @manage_db.command(name="queries", brief="show the slowest statements by total time")
+    @commands.is_owner()
+    async def query_stats(self, ctx, top: int = 10, reset: bool = False):
+        stats = self.bot.db.query_stats(top)
+
+        if not stats:
+            await ctx.send("No statements timed yet")
+
+        else:
+            lines = [
+                f"{'statement':<32} {'calls':>7} {'total':>8} {'mean':>8} {'p95':>8} {'max':>8} {'rows':>8} {'slow':>5}"
+            ]
+            for (name, s) in stats:
+                lines.append(
+                    f"{name:<32} {s['count']:>7} {s['total']:>8.3f} {s['mean']:>8.4f} {s['p95']:>8.4f} {s['max']:>8.4f} {s['rows']:>8} {s['slow']:>5}"
+                )
+
+            await ctx.send("```\n{}\n```".format("\n".join(lines)))
+
+        if reset:
+            self.bot.db.reset_query_stats()
+
+    @commands.command(name="exchange", brief="show exchange client stats")
+    @commands.is_owner()
+    async def exchange_stats(self, ctx):
+        lines = []
+        for (path, stats) in self.bot.payment_client.stats().items():
+            lines.append(f"{path}: {' '.join(f'{key}={value:.4g}' for (key, value) in stats.items())}")
+
+        await ctx.send("```\n{}\n```".format("\n".join(lines) or "No requests yet"))
+
+    @manage_db.command(name="errors", brief="show error log writer stats")
+    @commands.is_owner()
+    async def error_log_stats(self, ctx):
+        if logger.DATABASE_HANDLER is None:
+            await ctx.send("Database error logging is not set up")
+
+        else:
+            stats = logger.DATABASE_HANDLER.stats()
+            await ctx.send(f"```\n{' '.join(f'{key}={value}' for (key, value) in stats.items())}\n```")
+
 
 # TODO
 
@@ -187,9 +278,23 @@ class BrokerBot(commands.Bot):
 
         # TODO: aiohttp task here
 
-        self.db = SQL(**credentials["Database"], **self.config.get("Database"))
-
-        self.payment_client = PaymentClient(credentials["Exchange"]["api_key"])
+        # a read replica is only used if credentials.toml has a [Database.Replica] table
+        db_credentials = dict(credentials["Database"])
+        db_config = dict(self.config.get("Database"))
+        replica_config = db_config.pop("Replica", {})
+        replica_credentials = db_credentials.pop("Replica", None)
+        replica = None if replica_credentials is None else {**replica_config, **replica_credentials}
+
+        self.db = SQL(**db_credentials, **db_config, replica=replica, archive=self.config.get("Archive"))
+        logger.set_database(self.db)
+
+        self.payment_client = PaymentClient(
+            credentials["Exchange"]["api_key"],
+            connection=self.config["Exchange"].get("Connection"),
+            retry=self.config["Exchange"].get("Retry"),
+            rate_limit=self.config["Exchange"].get("RateLimit"),
+            balance_ttl=self.config["Exchange"].get("balance_ttl", BALANCE_TTL),
+        )
 
         self.ipc = ipc.Server(self, secret_key=credentials["IPC"]["secret"])
 
@@ -245,6 +350,13 @@ class BrokerBot(commands.Bot):
 
         return reaction
 
+    # the database and the exchange client are set up before logging in, so no command can run before they're ready
+    async def start(self, *args, **kwargs):
+        await self.db.init()
+        await self.payment_client.start()
+
+        await super().start(*args, **kwargs)
+
     # Discord events
 
     async def on_ready(self):
@@ -254,8 +366,6 @@ class BrokerBot(commands.Bot):
             f"Logged in as {self.user.name @ C.on_green}#{self.user.discriminator @ C.on_yellow.bold}{' DEBUG MODE' @ C.bright_magenta if self.debug else ''}\nLoaded in {boot_duration @ C.on_cyan}"
         )
 
-        await self.db.init()
-
         log.info("Started listening")
 
         await self.change_presence(activity=discord.Game(f"{self.config['General']['default_prefix']}help"))